@@ -58,8 +58,8 @@ def BuildBlocker(radius, height):
 	
 	blocker = make.rotate_extrude(x_value, y_value, nsteps)  
 	  
-	blocker = mh.rotate(blocker, make_rotation_matrix(+np.pi/2, (1,0,0)))
-	blocker = mh.shift(blocker, (0, 0, height))
+	blocker = mh.rotate(blocker, make_rotation_matrix(+np.pi/2, (1,0,0)), remove_duplicate_vertices=False)
+	blocker = mh.shift(blocker, (0, 0, height), remove_duplicate_vertices=False)
 	
 	return blocker
 	
@@ -69,8 +69,8 @@ def PlotBlocker(radius, height):
 	y_value = [0]*nsteps
 	
 	blocker = make.rotate_extrude(x_value, y_value, nsteps)    
-	blocker = mh.rotate(blocker, make_rotation_matrix(+np.pi/2, (1,0,0)))
-	blocker = mh.shift(blocker, (0, 0, height))
+	blocker = mh.rotate(blocker, make_rotation_matrix(+np.pi/2, (1,0,0)), remove_duplicate_vertices=False)
+	blocker = mh.shift(blocker, (0, 0, height), remove_duplicate_vertices=False)
 	
 	blocker_triangles = blocker.get_triangle_centers() 
 	blocker_vertices = blocker.assemble() 
@@ -0,0 +1,134 @@
+import numpy as np
+from numba import jit
+
+# Order of the independent components of the (symmetric) second moment matrix
+MOMENT_COMPONENTS = ((0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2))
+
+@jit(nopython=True)
+def _accumulate(pmt_bins, directions, counts, direction_sums, second_moments):
+    # Fold one batch of photons into the per-PMT running sums, in place
+    for i in range(len(pmt_bins)):
+        pmt = pmt_bins[i]
+        x = directions[i, 0]
+        y = directions[i, 1]
+        z = directions[i, 2]
+        counts[pmt] += 1
+        direction_sums[pmt, 0] += x
+        direction_sums[pmt, 1] += y
+        direction_sums[pmt, 2] += z
+        second_moments[pmt, 0] += x*x
+        second_moments[pmt, 1] += x*y
+        second_moments[pmt, 2] += x*z
+        second_moments[pmt, 3] += y*y
+        second_moments[pmt, 4] += y*z
+        second_moments[pmt, 5] += z*z
+
+def _accumulate_dtype(array, compact_dtype, dtype):
+    # Dtype to pass an array to _accumulate() with: its own if compact_dtype or dtype, so that it is not copied
+    return array.dtype if getattr(array, 'dtype', None) in (compact_dtype, dtype) else dtype
+
+def pmt_frames(mean_angles):
+    # For each PMT, get a pair of axes which form an orthonormal coordinate
+    # system with the PMT mean direction (same choice as DetectorResponseGaussAngle._grouped_pmt_calibration)
+    u_dir = np.cross(mean_angles, np.array([0., 0., 1.]))
+    degenerate = np.logical_not(np.einsum('ij,ij->i', u_dir, u_dir) > 0)   # In case mean_angle = [0,0,1]
+    u_dir[degenerate] = np.cross(mean_angles[degenerate], np.array([0., 1., 0.]))
+    u_norm = np.linalg.norm(u_dir, axis=1)
+    u_norm[u_norm == 0] = 1.
+    u_dir /= u_norm[:, np.newaxis]
+    v_dir = np.cross(mean_angles, u_dir)
+    return u_dir, v_dir
+
+class CalibrationAccumulator(object):
+    '''A CalibrationAccumulator holds the sufficient statistics for the GaussAngle
+    calibration of each PMT: the number of photons, the sum of their directions and
+    the sum of the outer products of their directions. Photons can be folded in one
+    event at a time, so memory is set by the number of PMTs rather than photons.
+    '''
+    def __init__(self, npmt_bins):
+        self.npmt_bins = npmt_bins
+        self.counts = np.zeros(npmt_bins, dtype=np.int64)
+        self.direction_sums = np.zeros((npmt_bins, 3), dtype=np.float64)
+        self.second_moments = np.zeros((npmt_bins, 6), dtype=np.float64)   # xx, xy, xz, yy, yz, zz
+
+    def add(self, pmt_bins, directions):
+        # pmt_bins - (n,) PMT index for each photon
+        # directions - (n, 3) unit direction from the hit back toward the photon origin
+        # Compact (int32, float32) inputs are used as they are: the sums are kept in float64 regardless
+        pmt_bins = np.ascontiguousarray(pmt_bins, dtype=_accumulate_dtype(pmt_bins, np.int32, np.int64))
+        directions = np.ascontiguousarray(directions, dtype=_accumulate_dtype(directions, np.float32, np.float64))
+        _accumulate(pmt_bins, directions, self.counts, self.direction_sums, self.second_moments)
+
+    def merge(self, other):
+        # Adds the sums of another accumulator (e.g. from a different range of events)
+        if other.npmt_bins != self.npmt_bins:
+            raise ValueError('Cannot merge accumulators with %d and %d PMT bins' % (self.npmt_bins, other.npmt_bins))
+        self.counts += other.counts
+        self.direction_sums += other.direction_sums
+        self.second_moments += other.second_moments
+        return self
+
+    def write_to_hdf5(self, h5group):
+        # Store the sums as datasets of an open h5py File or Group
+        h5group.create_dataset('pmt_counts', data=self.counts)
+        h5group.create_dataset('direction_sums', data=self.direction_sums)
+        h5group.create_dataset('second_moments', data=self.second_moments)
+
+    @classmethod
+    def read_from_hdf5(cls, h5group):
+        # Rebuild an accumulator from datasets written by write_to_hdf5() (or a dict of the same arrays)
+        accumulator = cls(len(h5group['pmt_counts']))
+        accumulator.counts[:] = h5group['pmt_counts'][()]
+        accumulator.direction_sums[:] = h5group['direction_sums'][()]
+        accumulator.second_moments[:] = h5group['second_moments'][()]
+        return accumulator
+
+    def moment_matrices(self):
+        # Returns the (npmt_bins, 3, 3) symmetric second moment matrices
+        matrices = np.empty((self.npmt_bins, 3, 3), dtype=np.float64)
+        for k, (i, j) in enumerate(MOMENT_COMPONENTS):
+            matrices[:, i, j] = self.second_moments[:, k]
+            matrices[:, j, i] = self.second_moments[:, k]
+        return matrices
+
+    def finalize(self, n_min=10, ddof=0):
+        # Returns the mean angle (npmt_bins, 3), the average of the u and v variances,
+        # and the u-v variance difference for each PMT.  PMTs with fewer than n_min
+        # (or 2) photons are left at zero, as in the photon-list calibration.
+        mean_angles = np.zeros((self.npmt_bins, 3))
+        variances = np.zeros(self.npmt_bins)
+        u_minus_v = np.zeros(self.npmt_bins)
+
+        good = (self.counts >= 2) & (self.counts >= n_min)
+        n = self.counts[good].astype(np.float64)
+        mean = self.direction_sums[good] / n[:, np.newaxis]
+        mean_angle = mean / np.linalg.norm(mean, axis=1)[:, np.newaxis]
+        u_dir, v_dir = pmt_frames(mean_angle)
+
+        # var(u.d) = u^T <d d^T> u - (u.<d>)^2, evaluated in the PMT's own frame so the
+        # projections are centered near zero and there is no cancellation to speak of
+        moments = self.moment_matrices()[good] / n[:, np.newaxis, np.newaxis]
+        u_var = np.einsum('ij,ijk,ik->i', u_dir, moments, u_dir) - np.einsum('ij,ij->i', u_dir, mean)**2
+        v_var = np.einsum('ij,ijk,ik->i', v_dir, moments, v_dir) - np.einsum('ij,ij->i', v_dir, mean)**2
+        if ddof:
+            u_var *= n/(n - ddof)
+            v_var *= n/(n - ddof)
+
+        mean_angles[good] = mean_angle
+        variances[good] = (u_var + v_var)/2.
+        u_minus_v[good] = u_var - v_var
+        return mean_angles, variances, u_minus_v
+
+    def sigma_relative_errors(self):
+        # Relative standard error of each PMT's sigma.  For Gaussian u and v projections sigma^2
+        # averages two variances with n-1 degrees of freedom each, so se(sigma)/sigma = 1/(2*sqrt(n-1)).
+        # PMTs with fewer than 2 photons get inf.
+        errors = np.full(self.npmt_bins, np.inf)
+        measured = self.counts >= 2
+        errors[measured] = 0.5/np.sqrt(self.counts[measured] - 1.)
+        return errors
+
+    def converged(self, target_precision, n_min=10):
+        # Boolean mask of the PMTs whose sigma is known to target_precision (relative standard error)
+        # from at least n_min photons
+        return (self.counts >= n_min) & (self.sigma_relative_errors() <= target_precision)
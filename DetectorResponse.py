@@ -1,15 +1,69 @@
 #from ShortIO.root_short import PDFRootWriter, PDFRootReader, ShortRootReader, AngleRootReader, AngleRootWriter
-from kabamland2 import get_curved_surf_triangle_centers, get_lens_triangle_centers
-from chroma.transform import make_rotation_matrix, normalize
+from analytic_geometry import get_lens_rotation_matrices, get_curved_surf_ring_edges, make_rotation_matrix, normalize
+import analytic_geometry
 from mpl_toolkits.mplot3d import Axes3D
 import matplotlib.pyplot as plt
 from scipy import spatial
 import detectorconfig
+import paths
 import numpy as np
+import h5py
+import os
+from multiprocessing.pool import ThreadPool
 #import time
 
 from logger_lfd import logger
 
+# Ways of finding the pixel of a hit (see _pmt_arr_surf()): KD-tree over the triangle centers of every curved surface,
+# lens system first and then a KD-tree over the triangle centers of one curved surface, or analytic
+BINNING_METHODS = ('kdtree', 'two_level', 'analytic')
+# Ways of getting the triangle centers and lens centers: from the chroma meshes (kabamland2), or in closed form (analytic_geometry)
+GEOMETRY_METHODS = ('mesh', 'analytic')
+LENS_SEARCH_BLOCK = 65536     # Hits per block when finding the lens system of each hit (bounds the (hits, lens systems) scratch array)
+KDTREE_QUERY_CHUNK = 65536    # Hits per KD-tree query when the queries are spread over threads (see query_tree())
+# Dtypes of the hit pipeline in compact mode (DetectorResponse(compact=True)): about half the memory for hit buffers and
+# calibration tables.  Positions are upcast to float64 only where precision needs it (KD-tree queries, sums).
+COMPACT_ID_DTYPE = np.int32        # PMT and lens ids
+COMPACT_RING_DTYPE = np.uint16     # Ring and pixel in ring
+COMPACT_FLOAT_DTYPE = np.float32   # Positions, directions and calibration tables
+FLAT_FACE_TOLERANCE = 1e-5    # Largest distance of a hit from the plane of its icosahedron face (flat detectors)
+
+# Arrays kept in the geometry cache file (see _read_geometry_cache()), all derived from the configuration alone
+GEOMETRY_CACHE_ARRAYS = ('triangle_centers', 'ring', 'lens_centers', 'lens_rotation_matrices', 'pmt_bin_centers', 'pmt_bin_lenses', 'pmt_bin_rings')
+
+def _map_dataset(filename, dataset):
+    # Memory map (read only) a contiguous, uncompressed hdf5 dataset, rather than reading it.  Falls back to reading
+    # datasets that are chunked or have no storage allocated.
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None:
+        return dataset[()]
+    return np.memmap(filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+
+def cells_in_sphere(centers, half_sizes, radius):
+    # Mask of the axis-aligned cells, centers (n, 3) and half edge lengths (3,), that overlap the sphere of the
+    # given radius about the origin: the point of each cell closest to the origin is within the radius
+    closest = np.maximum(np.abs(centers) - half_sizes, 0.)
+    return np.einsum('ij,ij->i', closest, closest) <= radius**2
+
+def query_tree(tree, pos_array, max_dist, pool=None, chunk=KDTREE_QUERY_CHUNK):
+    # Nearest neighbor of each position in a cKDTree: (int32 index, float32 distance), with index == tree.n for a miss.
+    # With a thread pool, the queries are split into chunks over its threads, which run in parallel since cKDTree
+    # releases the GIL.
+    pos_array = np.asarray(pos_array).reshape(-1, 3)     # float32 positions are upcast a chunk at a time
+    indices = np.empty(len(pos_array), dtype=np.int32)
+    distances = np.empty(len(pos_array), dtype=np.float32)
+    def query_chunk(start):
+        chunk_dist, chunk_index = tree.query(pos_array[start:start+chunk].astype(np.float64), distance_upper_bound=max_dist)
+        indices[start:start+len(chunk_index)] = chunk_index
+        distances[start:start+len(chunk_index)] = chunk_dist
+    starts = list(range(0, len(pos_array), chunk))
+    if pool is not None and len(starts) > 1:
+        pool.map(query_chunk, starts)
+    else:
+        for start in starts:
+            query_chunk(start)
+    return indices, distances
+
 class DetectorResponse(object):
     '''A DetectorResponse represents the information available to the detector
     after calibration. There are multiple subclasses, allowing for multiple
@@ -18,7 +72,7 @@ class DetectorResponse(object):
     The configuration of the detector is also stored in this object, so that
     its geometry is known.    
     '''
-    def __init__(self, config, detectorxbins=10, detectorybins=10, detectorzbins=10):
+    def __init__(self, config, detectorxbins=10, detectorybins=10, detectorzbins=10, binning='kdtree', geometry_cache=True, geometry='mesh', query_threads=1, compact=False):
         # TODO: Duplicates a lot of stuff in the config
         self.config = config   # To enable saving configuration with the calibration file
         self.configname = config.config_name  # Adding this for intermediate calibration file writing
@@ -56,9 +110,21 @@ class DetectorResponse(object):
         #self.lens_inverse_rotated_displacement_matrix = self.build_lensplane_inverse_rotated_displacement_matrix()
         #new properties for curved surface detectors
 
+        # Building the lens and curved surface meshes is slow, so the geometry is cached per configuration UUID and geometry method
+        if geometry not in GEOMETRY_METHODS:
+            raise ValueError('Unknown geometry method: %s (expected one of %s)' % (geometry, str(GEOMETRY_METHODS)))
+        self.pmt_bin_centers = None
+        geometry_file = paths.get_geometry_cache_file_name(self.configname) if geometry_cache else None
+        geometry_cached = geometry_file is not None and self._read_geometry_cache(geometry_file, geometry)
+        if geometry_cached or geometry == 'analytic':
+            geometry_module = analytic_geometry
+        else:
+            import kabamland2 as geometry_module      # Needs the chroma mesh stack
+
         # Comment this out to allow access to old calibration files
-        self.triangle_centers,self.n_triangles_per_surf,self.ring = get_curved_surf_triangle_centers(config.vtx, self.lns_rad, self.detector_r, self.focal_length, self.nsteps, config.base_pixels)
-        self.triangle_centers_tree = spatial.cKDTree(self.triangle_centers)
+        if not geometry_cached:
+            self.triangle_centers,self.n_triangles_per_surf,self.ring = geometry_module.get_curved_surf_triangle_centers(config.vtx, self.lns_rad, self.detector_r, self.focal_length, self.nsteps, config.base_pixels)
+        self._triangle_centers_tree = None     # Only built if needed (see triangle_centers_tree)
         self.n_pmts_per_surf = int(self.n_triangles_per_surf/2.)
 
         if not self.detector_r:
@@ -67,7 +133,10 @@ class DetectorResponse(object):
             self.npmt_bins = self.n_lens_sys*self.n_pmts_per_surf # One curved detecting surf for each lens system
 
         # Comment this out to allow access to old calibration files
-        self.lens_centers = get_lens_triangle_centers(config.vtx, self.lns_rad, config.diameter_ratio, config.thickness_ratio, config.half_EPD, config.blockers, blocker_thickness_ratio=config.blocker_thickness_ratio, light_confinement=config.light_confinement, focal_length=config.focal_length, lens_system_name=config.lens_system_name)
+        if not geometry_cached:
+            self.lens_centers = geometry_module.get_lens_triangle_centers(config.vtx, self.lns_rad, config.diameter_ratio, config.thickness_ratio, config.half_EPD, config.blockers, blocker_thickness_ratio=config.blocker_thickness_ratio, light_confinement=config.light_confinement, focal_length=config.focal_length, lens_system_name=config.lens_system_name)
+            # Every lens system is the same assembly, rotated into place: (n_lens_sys, 3, 3)
+            self.lens_rotation_matrices = get_lens_rotation_matrices(config.vtx)
         self.lens_rad = config.half_EPD 
 
         #self.calc1 = self.pmtxbins/self.pmt_side_length
@@ -81,6 +150,126 @@ class DetectorResponse(object):
 
         logger.info('Detector rings: %s, cumulative pixels in rings: %s' % (str(self.ring), str(self.c_rings)))
 
+        if binning not in BINNING_METHODS:
+            raise ValueError('Unknown binning method: %s (expected one of %s)' % (binning, str(BINNING_METHODS)))
+        self.binning = binning
+        # Threads for the KD-tree queries of bulk binning (see query_tree()).  One thread unless asked for, since callers
+        # may already be parallel (e.g. the calibration workers).
+        self.query_threads = query_threads
+        self._query_thread_pool = None    # (threads, ThreadPool), created on first use (see _query_pool())
+        self.set_compact(compact)
+        self._build_surface_geometry()
+        if geometry_file is not None and not geometry_cached:
+            self._write_geometry_cache(geometry_file, geometry)
+
+    def set_compact(self, compact=True):
+        # Compact mode: int32 PMT and lens ids, uint16 rings and pixels in ring, float32 directions and calibration tables
+        self.compact = compact
+        self.pmt_dtype = COMPACT_ID_DTYPE if compact else int
+        self.float_dtype = COMPACT_FLOAT_DTYPE if compact else np.float64
+
+    def _compact_bins(self, pmts, lenses, rings, pixels):
+        # Casts (pmts, lenses, rings, pixels in ring) to the compact dtypes, in compact mode
+        if not self.compact:
+            return pmts, lenses, rings, pixels
+        return (np.asarray(pmts).astype(COMPACT_ID_DTYPE, copy=False), np.asarray(lenses).astype(COMPACT_ID_DTYPE, copy=False),
+                np.asarray(rings).astype(COMPACT_RING_DTYPE, copy=False), np.asarray(pixels).astype(COMPACT_RING_DTYPE, copy=False))
+
+    def _query_pool(self):
+        # Thread pool for the KD-tree queries, kept for the life of the detector response.  None for a single thread.
+        if self.query_threads <= 1:
+            return None
+        if self._query_thread_pool is None or self._query_thread_pool[0] != self.query_threads:
+            if self._query_thread_pool is not None:
+                self._query_thread_pool[1].close()
+            self._query_thread_pool = (self.query_threads, ThreadPool(self.query_threads))
+        return self._query_thread_pool[1]
+
+    @property
+    def triangle_centers_tree(self):
+        # KD-tree over the triangle centers of all of the curved surfaces
+        if self._triangle_centers_tree is None:
+            self._triangle_centers_tree = spatial.cKDTree(self.triangle_centers)
+        return self._triangle_centers_tree
+
+    def _read_geometry_cache(self, geometry_file, geometry):
+        # Loads the geometry arrays from a cache file written for this configuration (same UUID) with the same geometry
+        # method, memory mapped.  Returns False, leaving the geometry to be built, if there is no such file.
+        if not os.path.exists(geometry_file):
+            return False
+        try:
+            with h5py.File(geometry_file, 'r') as h5file:
+                if h5file.attrs.get('config_UUID') != str(self.config.uuid):
+                    logger.info('Geometry cache file %s is for another configuration.  Not using it.' % geometry_file)
+                    return False
+                if h5file.attrs.get('geometry') != geometry:
+                    logger.info('Geometry cache file %s was built with %s geometry, not %s.  Not using it.' % (geometry_file, h5file.attrs.get('geometry'), geometry))
+                    return False
+                for name in GEOMETRY_CACHE_ARRAYS:
+                    setattr(self, name, _map_dataset(geometry_file, h5file[name]))
+                self.n_triangles_per_surf = int(h5file.attrs['n_triangles_per_surf'])
+        except (IOError, KeyError) as error:
+            logger.warning('Unable to read geometry cache file %s: %s' % (geometry_file, str(error)))
+            self.pmt_bin_centers = None
+            return False
+        logger.info('Using geometry cache file: %s' % geometry_file)
+        return True
+
+    def _write_geometry_cache(self, geometry_file, geometry):
+        # Datasets are left contiguous and uncompressed so that they can be memory mapped.  Written to a temporary
+        # file and renamed, so that concurrent workers never see a partial cache.
+        temp_file = '%s.%d.tmp' % (geometry_file, os.getpid())
+        try:
+            with h5py.File(temp_file, 'w') as h5file:
+                h5file.attrs['config_UUID'] = str(self.config.uuid)
+                h5file.attrs['n_triangles_per_surf'] = self.n_triangles_per_surf
+                h5file.attrs['geometry'] = geometry
+                for name in GEOMETRY_CACHE_ARRAYS:
+                    h5file.create_dataset(name, data=np.asarray(getattr(self, name)))
+            os.rename(temp_file, geometry_file)
+        except (IOError, OSError) as error:
+            logger.warning('Unable to write geometry cache file %s: %s' % (geometry_file, str(error)))
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            return
+        logger.info('Geometry cache file created: ' + geometry_file)
+
+    def _build_surface_geometry(self):
+        # Per lens system: the center of its curved surface (on the lens axis, by symmetry) and its direction from the
+        # detector center.  Per pixel of a lens system: its ring, and the azimuth of its center about the lens axis in the
+        # template frame (lens axis along z), from the centers of its two triangles on the first curved surface.
+        surfaces = self.triangle_centers.reshape(-1, self.n_triangles_per_surf, 3)
+        self.surface_centers = np.mean(surfaces, axis=1)
+        self.surface_directions = normalize(self.surface_centers)
+        self.pixel_rings = np.searchsorted(self.c_rings, np.arange(self.n_pmts_per_surf), side='right')
+        first_triangle = self.c_rings_rolled[self.pixel_rings] + np.arange(self.n_pmts_per_surf)   # 2*c_rings_rolled + pixel in ring
+        template_centers = np.dot(surfaces[0] - self.surface_centers[0], self.lens_rotation_matrices[0])   # R^T (x - center)
+        self.template_triangle_tree = spatial.cKDTree(template_centers)    # Shared by all lens systems, for the two level binning
+        self.surface_extent = np.max(np.linalg.norm(template_centers, axis=1))
+        pixel_centers = template_centers[first_triangle] + template_centers[first_triangle + self.ring[self.pixel_rings]]
+        self.pixel_azimuths = np.arctan2(pixel_centers[:,1], pixel_centers[:,0])
+
+        # Dense per PMT tables over all lens systems, for pmt_bin_to_position(): the PMT center (midpoint of the centers
+        # of its two triangles), its lens system and its ring.  Already set if loaded from the geometry cache.
+        if self.pmt_bin_centers is None:
+            n_surfaces = len(surfaces)
+            pmt_triangles = np.arange(n_surfaces)[:,np.newaxis]*self.n_triangles_per_surf + first_triangle
+            pmt_centers = (self.triangle_centers[pmt_triangles] + self.triangle_centers[pmt_triangles + self.ring[self.pixel_rings]])/2.0
+            self.pmt_bin_centers = pmt_centers.reshape(-1, 3).astype(np.float32)
+            self.pmt_bin_lenses = np.repeat(np.arange(n_surfaces), self.n_pmts_per_surf)
+            self.pmt_bin_rings = np.tile(self.pixel_rings, n_surfaces)
+
+        # The rings are bounded by polar angles about the center of curvature, and each ring is divided into equal
+        # azimuth steps starting from the template x axis.  Since a pixel lies within its azimuth step, the step
+        # its center falls in gives the pixel that covers each step.
+        self.ring_polar_edges = get_curved_surf_ring_edges(self.detector_r, self.lns_rad, self.nsteps)
+        pixel_steps = np.floor(np.mod(self.pixel_azimuths, 2*np.pi)*self.ring[self.pixel_rings]/(2*np.pi)).astype(int)
+        self.azimuth_step_pixels = np.zeros(self.n_pmts_per_surf, dtype=int)
+        self.azimuth_step_pixels[self.c_rings_rolled[self.pixel_rings] + pixel_steps] = np.arange(self.n_pmts_per_surf) - self.c_rings_rolled[self.pixel_rings]
+        if len(np.unique(self.c_rings_rolled[self.pixel_rings] + pixel_steps)) != self.n_pmts_per_surf:
+            logger.warning('Pixel centers do not fall in distinct azimuth steps: analytic binning will not match the KD-tree')
+        self.check_pixel_map()       # Self test of the pixel mapping: cheap, only one surface's triangles
+
     def build_rotation_matrices(self):
         rotation_matrices = np.empty((20, 3, 3))
         for k in range(20):
@@ -110,7 +299,7 @@ class DetectorResponse(object):
         self.is_calibrated = True
         print "Base class DetectorResponse has no specific calibration method - instantiate as a subclass."
         
-    def angles_response(self, config, simname, nolens=False, rmax_frac=1.0):
+    def angles_response(self, config, simname, nolens=False, rmax_frac=1.0, return_culprits=False):
         # takes a simulation file and creates an array of angles that photons hit the pmts at.
         # (replace lenses with disk pmts for the simulation to see what angles light hits the lenses at.
         # Light needs to land on an icosahedron face plane so use disks instead of just changing the surface of the lens to detecting.)
@@ -118,9 +307,12 @@ class DetectorResponse(object):
 
         #If nolens is True, assumes a "perfectres" type detector, with no lenses instead of lenses replaced with PMTs.
         #Restricts starting photons to be w/in rmax_frac*inscribed_radius of the center.
+        #With return_culprits, also returns the number of photons that were not on any face.
         reader = ShortRootReader(simname)
         total_angles = np.zeros(0)
+        culprits = 0
         loops = 0
+        face_directions = normalize(self.facecoords)
         for ev in reader:
             detected = (ev.photons_end.flags & (0x1 <<2)).astype(bool)
             # Check which photons start w/in r_max of center
@@ -133,36 +325,21 @@ class DetectorResponse(object):
             use_photon = np.logical_and(detected, start_in_bounds)          
             beginning_photons = ev.photons_beg.pos[use_photon]
             ending_photons = ev.photons_end.pos[use_photon]
-            transpose_pos_array = np.transpose(ending_photons)
-            length = np.shape(ending_photons)[0]
- 
-            facebin_array = -np.ones(length).astype(int)
+
             # finding which LENS face each position belongs to by seeing which inverse rotation and displacement brings the position closest to z = 0. Note this is different than finding the PMT face as in find_pmt_bin_array.
             # Will find the PMT face if nolens is True
-            for k in range(20):
-                if nolens:
-                    initial_position_array = np.transpose(np.dot(self.inverse_rotation_matrices[k], transpose_pos_array)) - self.inverse_rotated_displacement_matrix[k]
-                else:
-                    initial_position_array = np.transpose(np.dot(self.inverse_rotation_matrices[k], transpose_pos_array)) - self.lens_inverse_rotated_displacement_matrix[k]
-
-                wherezeros = (initial_position_array[:,2] < 1e-5) & (initial_position_array[:,2] > -1e-5)
-                np.place(facebin_array, wherezeros, k)
-            #print facebin_array
+            if nolens:
+                facebin_array, _ = self._flat_faces(ending_photons, self.inverse_rotated_displacement_matrix)
+            else:
+                facebin_array, _ = self._flat_faces(ending_photons, self.lens_inverse_rotated_displacement_matrix)
+            on_face = facebin_array != -1
+            culprits += np.count_nonzero(np.logical_not(on_face))
 
             #finding the angles between each direction and facecoord (facecoords[k] representing the optical axis of every lens on the kth face.)
             directions = normalize(ending_photons - beginning_photons)
-            face_directions = normalize(self.facecoords)
-            angles = -np.ones(length)
-            for i in range(length):
-                face = facebin_array[i]
-                if face == -1:
-                    continue
-                angles[i] = np.arccos(np.dot(directions[i], face_directions[face]))
-
-            if total_angles == []:
-                total_angles = angles
-            else:
-                total_angles = np.append(total_angles, angles)
+            angles = -np.ones(len(ending_photons))
+            angles[on_face] = np.arccos(np.einsum('ij,ij->i', directions[on_face], face_directions[facebin_array[on_face]]))
+            total_angles = np.append(total_angles, angles)
 
             loops += 1
             if np.mod(loops, 10) == 0:
@@ -172,13 +349,7 @@ class DetectorResponse(object):
 
         #sorting from lowest to highest and removing any -1s. 
         total_angles = np.sort(total_angles)
-        first_good = 0
-        for i in range(np.shape(total_angles)[0]):
-            if total_angles[i] == -1:
-                continue
-            else:
-                first_good = i
-                break
+        first_good = np.count_nonzero(total_angles == -1)
         total_angles = total_angles[first_good:]
         
         def choose_values(values, num):
@@ -205,6 +376,8 @@ class DetectorResponse(object):
         plt.title('Angles Response Histogram for ' + config.config_name)
         plt.show()
 
+        if return_culprits:
+            return total_angles, culprits
         return total_angles
 
     def build_perfect_resolution_direction_list(self, simname, filename):
@@ -288,41 +461,153 @@ class DetectorResponse(object):
 
         return detector_dir_list
 
-    def _scaled_pmt_arr_surf(self, closest_triangle_index):
+    def _scaled_pmt_arr_surf(self, closest_triangle_index, validate=False):
+        # Pixel of each triangle index (from find_closest_triangle_center()).  Ring r of a curved surface holds
+        # triangles [2*c_rings_rolled[r], 2*c_rings[r]), and both halves of that range cover its pixels in order.
+        # A miss (index == len(triangle_centers)) comes out as pmt_number == npmt_bins.
         closest_triangle_index = np.asarray(closest_triangle_index)
-        curved_surface_index = (closest_triangle_index/self.n_triangles_per_surf).astype(int)
+        curved_surface_index = closest_triangle_index // self.n_triangles_per_surf
         renorm_triangle = closest_triangle_index % self.n_triangles_per_surf
+        ring = np.searchsorted(2*self.c_rings, renorm_triangle, side='right')
+        pixel_number_in_ring = (renorm_triangle - 2*self.c_rings_rolled[ring]) % self.ring[ring]
+        pmt_number = pixel_number_in_ring + self.c_rings_rolled[ring] + curved_surface_index*self.n_pmts_per_surf
+        if validate:
+            self.check_pixel_map(closest_triangle_index, pmt_number)
+        return pmt_number, curved_surface_index, ring, pixel_number_in_ring
 
-        mtx = (np.tile(2 * self.c_rings_rolled, (len(renorm_triangle), 1)).T - renorm_triangle).T
-        pixels_outside_hit_ring = self.c_rings_rolled[np.argmax(mtx > 0, axis=1) - 1]   # TODO: This may not be the right name for this??
-        complicated = ((renorm_triangle - 2*pixels_outside_hit_ring) % self.ring[np.argmax(mtx>0,axis=1)-1])   # TODO this variable name is just a placeholder
-
-        pmt_number = complicated + pixels_outside_hit_ring + curved_surface_index*self.n_pmts_per_surf
-
-        ### Alternative calculation  for cross check ###
-        new_lens_number = (pmt_number / self.n_pmts_per_surf).astype(int)
-        pixel_number_in_lens = pmt_number - curved_surface_index*self.n_pmts_per_surf       # Depends on PMT number...
-        ring = np.searchsorted(self.c_rings, pixel_number_in_lens, side='right')
-        pixel_number_in_ring = pixel_number_in_lens - self.c_rings_rolled[ring]
-        pixels_outside_hit_ring2 = self.c_rings_rolled[ring]
-        pmt_number2 = pixel_number_in_ring + pixels_outside_hit_ring2 + curved_surface_index*self.n_pmts_per_surf
-
-        for i in range(len(closest_triangle_index)):
-            if new_lens_number[i] != curved_surface_index[i]:
-                print('Lens number mismatch: %d, %d, %d' % (i, new_lens_number[i], new_lens_number[i]))
-            if pmt_number[i] != pmt_number2[i]:
-                print('Pixel number mismatch: %d, %d, %d, %d' % (i, pmt_number[i], pmt_number2[i], pmt_number[i] - pmt_number2[i]))
-            if pixel_number_in_ring[i] != complicated[i]:
-                print('Pixel number in ring mismatch: %d, %d, %d, %d' % (i, pixel_number_in_ring[i], complicated[i], pixel_number_in_ring[i] - complicated[i]))
-            if pixels_outside_hit_ring[i] != pixels_outside_hit_ring2[i]:
-                print('Pixel number outside ring mismatch: %d, %d, %d, %d, ring: %d' % (i, pixels_outside_hit_ring[i], pixels_outside_hit_ring2[i], pixels_outside_hit_ring[i] - pixels_outside_hit_ring2[i], ring[i]))
+    def check_pixel_map(self, closest_triangle_index=None, pmt_number=None):
+        # Cross checks _scaled_pmt_arr_surf() against the original ring search (every ring boundary compared against
+        # every triangle) and against the inverse pixel -> ring mapping.  With no arguments, checks every triangle of
+        # the first curved surface, which covers the mapping of all of them.  Returns the number of mismatches.
+        if closest_triangle_index is None:
+            closest_triangle_index = np.arange(self.n_triangles_per_surf)
+            pmt_number = self._scaled_pmt_arr_surf(closest_triangle_index)[0]
+        closest_triangle_index = np.asarray(closest_triangle_index)
+        curved_surface_index = closest_triangle_index // self.n_triangles_per_surf
+        renorm_triangle = closest_triangle_index % self.n_triangles_per_surf
 
-        return pmt_number, curved_surface_index, ring, pixel_number_in_ring
+        hit_ring = np.argmax((2*self.c_rings_rolled)[np.newaxis,:] > renorm_triangle[:,np.newaxis], axis=1) - 1
+        pixels_outside_hit_ring = self.c_rings_rolled[hit_ring]
+        pmt_number_ref = (renorm_triangle - 2*pixels_outside_hit_ring) % self.ring[hit_ring] + pixels_outside_hit_ring + curved_surface_index*self.n_pmts_per_surf
+
+        pixel_number_in_lens = pmt_number - curved_surface_index*self.n_pmts_per_surf
+        lens_mismatches = np.count_nonzero(pmt_number // self.n_pmts_per_surf != curved_surface_index)
+        pixel_mismatches = np.count_nonzero(pmt_number != pmt_number_ref)
+        ring_mismatches = np.count_nonzero(np.searchsorted(self.c_rings, pixel_number_in_lens, side='right') != hit_ring % len(self.ring))
+        mismatches = lens_mismatches + pixel_mismatches + ring_mismatches
+        if mismatches:
+            logger.warning('Pixel map check failed on %d triangles: %d lens, %d pixel and %d ring mismatches' %
+                           (len(closest_triangle_index), lens_mismatches, pixel_mismatches, ring_mismatches))
+        return mismatches
+
+    def _flat_faces(self, pos_array, inverse_rotated_displacements):
+        # Icosahedron face of each position (-1 if none) and the position in the frame of that face: the face whose inverse
+        # rotation and displacement brings the position closest to z = 0, for all 20 faces at once (in blocks of hits)
+        pos_array = np.asarray(pos_array, dtype=float)
+        faces = np.empty(len(pos_array), dtype=int)
+        for start in range(0, len(pos_array), LENS_SEARCH_BLOCK):
+            block = pos_array[start:start+LENS_SEARCH_BLOCK]
+            face_z = np.dot(block, self.inverse_rotation_matrices[:,2,:].T) - inverse_rotated_displacements[:,2]
+            faces[start:start+len(block)] = np.argmin(np.abs(face_z), axis=1)
+        face_positions = np.einsum('nij,nj->ni', self.inverse_rotation_matrices[faces], pos_array) - inverse_rotated_displacements[faces]
+        faces[np.logical_not(np.abs(face_positions[:,2]) < FLAT_FACE_TOLERANCE)] = -1
+        return faces, face_positions
+
+    def _closest_lens_systems(self, pos_array):
+        # Index of the lens system whose curved surface is in the direction closest to each position
+        lenses = np.empty(len(pos_array), dtype=int)
+        for start in range(0, len(pos_array), LENS_SEARCH_BLOCK):
+            block = pos_array[start:start+LENS_SEARCH_BLOCK]
+            lenses[start:start+len(block)] = np.argmax(np.dot(block, self.surface_directions.T), axis=1)
+        return lenses
+
+    def _analytic_pmt_arr_surf(self, pos_array):
+        # Same as _scaled_pmt_arr_surf(find_closest_triangle_center(pos_array)[0]), without the KD-tree: each hit is rotated
+        # into the frame of its lens system, the ring comes from its polar angle about the center of curvature of the
+        # surface and the pixel from its azimuth.  Hits beyond the outer ring, or further from the surface than the KD-tree
+        # search distance, get pmt number npmt_bins.
+        pos_array = np.asarray(pos_array, dtype=np.float64).reshape(-1, 3)
+        lenses = self._closest_lens_systems(pos_array)
+        local_pos = np.einsum('nji,nj->ni', self.lens_rotation_matrices[lenses], pos_array - self.surface_centers[lenses])
+        radius = np.hypot(local_pos[:,0], local_pos[:,1])
+        azimuth = np.mod(np.arctan2(local_pos[:,1], local_pos[:,0]), 2*np.pi)
+        rings = self._polar_rings(radius)
+        max_dist = 1.1*2*np.pi*self.lns_rad/self.nsteps     # As in find_closest_triangle_center()
+        bad_bins = (rings < 0) | (np.linalg.norm(local_pos, axis=1) > self.surface_extent + max_dist)
+        rings[bad_bins] = 0
+
+        # The pixels are flat: within a ring of n pixels, radius*cos(azimuth - pixel center)/cos(pi/n) is the radius on the
+        # sphere, which is larger than the radius of the hit everywhere but on the pixel edges.  So the hit may be in the next
+        # ring out, but no further.
+        steps = self._azimuth_steps(azimuth, rings)
+        step_width = 2*np.pi/self.ring[rings]
+        sphere_radius = radius*np.cos(azimuth - (steps + 0.5)*step_width)/np.cos(step_width/2)
+        outer_ring = (self._polar_rings(sphere_radius) < rings) & (rings > 0)
+        rings[outer_ring] -= 1
+        steps[outer_ring] = self._azimuth_steps(azimuth[outer_ring], rings[outer_ring])
+
+        pixel_number_in_ring = self.azimuth_step_pixels[self.c_rings_rolled[rings] + steps]
+        pmt_number = pixel_number_in_ring + self.c_rings_rolled[rings] + lenses*self.n_pmts_per_surf
+        pmt_number[bad_bins] = self.npmt_bins
+        return pmt_number, lenses, rings, pixel_number_in_ring
+
+    def _polar_rings(self, radius):
+        # Ring containing the points of the curved surface at 'radius' from the lens axis; -1 beyond the outer ring
+        polar = np.arcsin(np.minimum(radius/self.detector_r, 1.))
+        return len(self.ring) - np.searchsorted(self.ring_polar_edges[::-1], polar, side='right')
+
+    def _azimuth_steps(self, azimuth, rings):
+        # Azimuth step of each point within its ring (azimuth in [0, 2*pi))
+        steps = np.floor(azimuth*self.ring[rings]/(2*np.pi)).astype(int)
+        return np.minimum(steps, self.ring[rings] - 1)      # An azimuth that rounds to 2*pi
+
+    def _two_level_closest_triangle(self, pos_array, max_dist=1.):
+        # Same as find_closest_triangle_center(), but with the lens system found first and the hit then looked
+        # up in the (single surface) template triangle tree, in the frame of that lens system
+        if(max_dist == 1.):
+            max_dist = 1.1*2*np.pi*self.lns_rad/self.nsteps
+        pos_array = np.asarray(pos_array, dtype=np.float64).reshape(-1, 3)
+        lenses = self._closest_lens_systems(pos_array)
+        local_pos = np.einsum('nji,nj->ni', self.lens_rotation_matrices[lenses], pos_array - self.surface_centers[lenses])
+        template_index, closest_triangle_dist = query_tree(self.template_triangle_tree, local_pos, max_dist, self._query_pool())
+        closest_triangle_index = (lenses*self.n_triangles_per_surf + template_index).astype(np.int32)
+        closest_triangle_index[template_index >= self.n_triangles_per_surf] = len(self.triangle_centers)   # A miss, as for the full tree
+        return closest_triangle_index, closest_triangle_dist
+
+    def _pmt_arr_surf(self, pos_array):
+        # (pmts, lenses, rings, pixels in ring) of hits on the curved surfaces, with the binning method in self.binning
+        if self.binning == 'analytic':
+            return self._compact_bins(*self._analytic_pmt_arr_surf(pos_array))
+        if self.binning == 'two_level':
+            closest_triangle_index, _ = self._two_level_closest_triangle(pos_array, max_dist=1.)
+        else:
+            closest_triangle_index, _ = self.find_closest_triangle_center(pos_array, max_dist=1.)
+        return self._compact_bins(*self._scaled_pmt_arr_surf(closest_triangle_index))
+
+    def validate_binning(self, pos_array):
+        # Bins the same hits with self.binning and with the full KD-tree.  Returns the fraction of hits in the same pixel,
+        # and the fraction in a different lens system, or more than one ring or pixel apart.  The nearest triangle center
+        # is not always on the pixel hit, so the analytic binning only needs to agree up to neighboring pixels.
+        closest_triangle_index, _ = self.find_closest_triangle_center(pos_array, max_dist=1.)
+        kdtree_pmts, kdtree_lenses, kdtree_rings, kdtree_pixels = self._scaled_pmt_arr_surf(closest_triangle_index)
+        pmts, lenses, rings, pixels = self._pmt_arr_surf(pos_array)
+        if len(pmts) == 0:
+            return 1., 0.
+        kdtree_pmts = np.minimum(kdtree_pmts, self.npmt_bins)     # Misses are >= npmt_bins
+        pmts = np.minimum(pmts, self.npmt_bins)
+        pixel_distance = np.abs(kdtree_pixels - pixels)
+        pixel_distance = np.minimum(pixel_distance, self.ring[rings % len(self.ring)] - pixel_distance)   # Around the ring
+        far = (kdtree_pmts >= self.npmt_bins) | (pmts >= self.npmt_bins) | (kdtree_lenses != lenses) | \
+              (np.abs(kdtree_rings - rings) > 1) | ((kdtree_rings == rings) & (pixel_distance > 1))
+        far &= kdtree_pmts != pmts
+        agreement = np.mean(kdtree_pmts == pmts)
+        logger.info('%s binning agrees with the KD-tree for %d of %d hits (%f); %d are not in neighboring pixels' %
+                    (self.binning, np.sum(kdtree_pmts == pmts), len(pmts), agreement, np.sum(far)))
+        return agreement, np.mean(far)
 
 	# Currently used only in EventAnalyzer.generate_tracks()
     def find_pmt_bin_array_new(self, pos_array):
-        closest_triangle_index, closest_triangle_dist = self.find_closest_triangle_center(pos_array, max_dist=1.)
-        pmts, lenses, rings, pixels = self._scaled_pmt_arr_surf(closest_triangle_index)
+        pmts, lenses, rings, pixels = self._pmt_arr_surf(pos_array)
         bad_bins = np.array(pmts) >= self.npmt_bins
 
         if sum(bad_bins) > 0:
@@ -335,56 +620,39 @@ class DetectorResponse(object):
             print('New bin array length: ' + str(len(pmts)))
         return pmts, lenses, rings, pixels
 
-    def find_pmt_bin_array(self, pos_array):
+    def find_pmt_bin_array(self, pos_array, return_culprits=False):
+        # With return_culprits, also returns the number of photons that could not be binned
         if(self.detector_r == 0):   # This code is specific to the icosahedron
-            # returns an array of global pmt bins corresponding to an array of end-positions
-            length = np.shape(pos_array)[0]
-            #facebin array is left as -1s, that way if a particular photon does not get placed onto a side, it gets ignored (including its pmt_position) in the checking stages at the bottom of this function.
-            facebin_array = -np.ones(length).astype(int)
-            pmt_positions = np.empty((length, 3))
-            bin_array = np.empty(length)
-            transpose_pos_array = np.transpose(pos_array)
-            
-            # finding which PMT face each position belongs to by seeing which inverse rotation and displacement brings the position closest to z = 0
-            for k in range(20):
-                initial_position_array = np.transpose(np.dot(self.inverse_rotation_matrices[k], transpose_pos_array)) - self.inverse_rotated_displacement_matrix[k]
-
-                #creating the facebin_array and pmt_positions based upon if for this value of k the initial_position of the zcoord is close to 0.
-                wherezeros = (initial_position_array[:,2] < 1e-5) & (initial_position_array[:,2] > -1e-5)
-                reshapedwherezeros = np.column_stack((wherezeros, wherezeros, wherezeros))
-                np.place(facebin_array, wherezeros, k)
-                np.copyto(pmt_positions, initial_position_array, where=reshapedwherezeros)
-
+            # returns an array of global pmt bins corresponding to an array of end-positions, -1 for any bad or impossible bins
+            facebin_array, pmt_positions = self._flat_faces(pos_array, self.inverse_rotated_displacement_matrix)
             xbin_array = np.floor(self.calc1*pmt_positions[:,0] + self.calc2)
             ybin_array = np.floor(self.calc3*pmt_positions[:,1] + self.calc4)
             
             #making a single bin index from the x, y and facebins.
-            bin_array = facebin_array*self.calc5 + ybin_array*self.pmtxbins + xbin_array
-            #returning -1 for any bad or impossible bins
-            for i in range(length):
-                if (xbin_array[i] >= self.pmtxbins) or (xbin_array[i] < 0) or (ybin_array[i] >= self.pmtybins) or (ybin_array[i] < 0) or (facebin_array[i] == -1):
-                    bin_array[i] = -1
-                    print("photon " + str(i) + " is a culprit")
-            return bin_array.astype(int)
+            bin_array = (facebin_array*self.calc5 + ybin_array*self.pmtxbins + xbin_array).astype(int)
+            culprits = (xbin_array >= self.pmtxbins) | (xbin_array < 0) | (ybin_array >= self.pmtybins) | (ybin_array < 0) | (facebin_array == -1)
+            bin_array[culprits] = -1
+            if return_culprits:
+                return bin_array, np.count_nonzero(culprits)
+            return bin_array
             
         else:
             #print("Curved surface detector was selected.")
-            closest_triangle_index, closest_triangle_dist = self.find_closest_triangle_center(pos_array, max_dist=1.)  # TODO: check out the addition of the max_dist parameter
-            bin_array, _, _, _ = self._scaled_pmt_arr_surf(closest_triangle_index)
+            bin_array, _, _, _ = self._pmt_arr_surf(pos_array)
             bad_bins = np.array(bin_array) >= self.npmt_bins
             if sum(bad_bins) > 0:
                 print "The following %s photons were not associated to a PMT: "%sum(bad_bins)
                 print np.where(bad_bins)[0]
+            if return_culprits:
+                return bin_array[np.logical_not(bad_bins)], np.count_nonzero(bad_bins)
             return bin_array[np.logical_not(bad_bins)]
 
     def find_closest_triangle_center(self, pos_array, max_dist = 1.):
         #print "Finding closest triangle centers..."
         if(max_dist == 1.):
             max_dist = 1.1*2*np.pi*self.lns_rad/self.nsteps # Circumference of detecting surface divided by number of steps, with 1.1x of wiggle room
-        query_results = self.triangle_centers_tree.query(pos_array,distance_upper_bound = max_dist)
-        closest_triangle_index = query_results[1].tolist()
-        closest_triangle_dist = query_results[0].tolist()
-        return closest_triangle_index, closest_triangle_dist
+        # int32 indices (len(triangle_centers) for a miss) and float32 distances, queried in chunks over query_threads threads
+        return query_tree(self.triangle_centers_tree, pos_array, max_dist, self._query_pool())
 
     def plot_pdf(self, pdf, plot_title, photon_start=None, photon_end=None, bin_pos=None, show=True):
         # Returns a 3D plot of detector pdf, with each point's size proportional to its
@@ -461,23 +729,8 @@ class DetectorResponse(object):
                 bin_coord = np.einsum('ijk,ki->ij',self.rotation_matrices[facebin], init_coord) + self.displacement_matrix[facebin]
             return bin_coord
         else:
-            # Get indices of curved surfaces hit, then translate to first of two triangles hit
-            curved_surf_bin = (pmtbin/self.n_pmts_per_surf) # Integer division - drops remainder
-            ring_div = np.einsum('i,j->ij',pmtbin % self.n_pmts_per_surf,1./np.cumsum(self.ring)).astype(int)
-            zero_sel = np.where(ring_div==0)
-            label, counts = np.unique(zero_sel[0],return_index=True)
-            ring_label = zero_sel[1][counts]
-            cumulative_ring = np.roll(np.cumsum(self.ring),1)
-            cumulative_ring[0] = 0
-            ring_offset = cumulative_ring[ring_label]
-            triangle_bin1 = curved_surf_bin*self.n_triangles_per_surf + ring_offset + (pmtbin % self.n_pmts_per_surf)
-            triangle_bin2 = triangle_bin1+self.ring[ring_label] # Second triangle for this PMT
-            triangle_pos1 = self.triangle_centers[triangle_bin1]
-            triangle_pos2 = self.triangle_centers[triangle_bin2]
-
-            bin_pos = (triangle_pos1+triangle_pos2)/2.0
-
-            return bin_pos
+            # Center of the PMT: midpoint of the centers of its two triangles, precomputed in _build_surface_geometry()
+            return self.pmt_bin_centers[pmtbin]
    
     def bin_to_position(self, bintup):
         #takes a detector bin tuple and outputs the coordinate position tuple at the CENTER of the bin
@@ -488,13 +741,30 @@ class DetectorResponse(object):
         return (xpos,ypos,zpos)
 
     def bin_to_position_array(self):
-        #returns an array of coordinate centers for each bin.
-        x, y, z = np.mgrid[0:self.detectorxbins, 0:self.detectorybins, 0:self.detectorzbins]
-        xpos = (x+(1.0-self.detectorxbins)/2.0)*(2.0*self.inscribed_radius/self.detectorxbins)
-        ypos = (y+(1.0-self.detectorybins)/2.0)*(2.0*self.inscribed_radius/self.detectorybins)
-        zpos = (z+(1.0-self.detectorzbins)/2.0)*(2.0*self.inscribed_radius/self.detectorzbins)
-        position_array = zip(xpos.ravel(), ypos.ravel(), zpos.ravel())
-        return position_array
+        #returns an (n, 3) array of coordinate centers for each bin, in bin order.
+        #the array is built once (per binning) and shared between calls, so it is read only.
+        key = (self.detectorxbins, self.detectorybins, self.detectorzbins, self.inscribed_radius)
+        if getattr(self, '_bin_positions_key', None) != key:
+            x, y, z = np.mgrid[0:self.detectorxbins, 0:self.detectorybins, 0:self.detectorzbins]
+            xpos = (x+(1.0-self.detectorxbins)/2.0)*(2.0*self.inscribed_radius/self.detectorxbins)
+            ypos = (y+(1.0-self.detectorybins)/2.0)*(2.0*self.inscribed_radius/self.detectorybins)
+            zpos = (z+(1.0-self.detectorzbins)/2.0)*(2.0*self.inscribed_radius/self.detectorzbins)
+            position_array = np.array([xpos.ravel(), ypos.ravel(), zpos.ravel()]).T
+            position_array.flags.writeable = False
+            fiducial_array = position_array[cells_in_sphere(position_array, self.bin_size()/2., self.inscribed_radius)]
+            fiducial_array.flags.writeable = False
+            self._bin_positions, self._fiducial_bin_positions = position_array, fiducial_array
+            self._bin_positions_key = key
+        return self._bin_positions
+
+    def fiducial_bin_positions(self):
+        #returns the centers (n, 3) of the bins that overlap the inscribed sphere (cached and read only, as above)
+        self.bin_to_position_array()
+        return self._fiducial_bin_positions
+
+    def bin_size(self):
+        #returns the (3,) edge lengths of the detector bins
+        return 2.0*self.inscribed_radius/np.array([self.detectorxbins, self.detectorybins, self.detectorzbins], dtype=float)
                 
     def write_to_ROOT(self, filename):
         print "Base class DetectorResponse has nothing to write - instantiate as a subclass."
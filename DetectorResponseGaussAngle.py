@@ -1,78 +1,130 @@
-from DetectorResponse import DetectorResponse
+from DetectorResponse import DetectorResponse, BINNING_METHODS
 from chroma.transform import normalize
-from chroma.event import Photons
 
 import matplotlib.pyplot as plt
 import numpy as np
 from numba import jit
 import time
-import pickle
+import os
+import multiprocessing
 import h5py
 import deepdish as dd
 
 import linalg_3
+import simulation_reader
+from CalibrationAccumulator import CalibrationAccumulator
 from logger_lfd import logger
 
+PRECISION_CHECK_EVENTS = 100     # Events between convergence checks when calibrating to a target precision
+BINNING_MISMATCH = 0.001   # Largest fraction of hits allowed outside the KD-tree pixel and its neighbors
+
 # Original is in chroma.transform
 @jit(nopython=True)
 def norm(x):
     "Returns the norm of the vector `x`."
     return np.sqrt((x*x).sum(-1))
 
-# Dot product of a 2d array with a 1d array
-@jit(nopython=True)
-def my_dot(array1, array2):
-    result = np.empty(len(array1), dtype=np.float64)      # May not need 64?
-    i = 0
-    for i in range(len(array1)):
-        result[i] = linalg_3.dot(array1[i], array2)
-        i += 1
-    return result
-
-def assign_photons(npmt_bins, n_det, pmt_bins):
+def group_photons_by_pmt(npmt_bins, pmt_bins):
+    # Returns the photon indices sorted by PMT, and CSR offsets into them:
+    # the photons hitting PMT i are order[offsets[i]:offsets[i+1]]
     start = time.time()
-    pmt_photons = np.empty(npmt_bins, dtype=list)
-    for photon in range(n_det):
-        if photon % 1000000 == 0:
-            logger.info("Photon " + str(photon) + " of " + str(n_det) + ': ' + str(time.time() - start))
-        pmt = int(pmt_bins[photon])
-        if pmt_photons[pmt] is None:
-            pmt_photons[pmt] = [photon]
-        else:
-            pmt_photons[pmt] += [photon]
-    return pmt_photons
+    order = np.argsort(pmt_bins, kind='mergesort')    # Stable, so photons stay in event order within a PMT
+    offsets = np.zeros(npmt_bins+1, dtype=np.int64)
+    np.cumsum(np.bincount(pmt_bins, minlength=npmt_bins), out=offsets[1:])
+    logger.info("Grouped " + str(len(pmt_bins)) + " photons by PMT: " + str(time.time() - start))
+    return order, offsets
 
 @jit(nopython=True)
-def compute_pmt_calibration(angles_for_pmt, n_min):
-    mean = np.array([np.mean(angles_for_pmt[:,0]), np.mean(angles_for_pmt[:,1]), np.mean(angles_for_pmt[:,2])])
-    mean_angle = mean / norm(mean)
-
-    # For each PMT, get a pair of axes which form an
-    # orthonormal coordinate system with the PMT mean direction
-    u_dir = linalg_3.cross(mean_angle,np.array([0,0,1]))
-    if not (np.dot(u_dir, u_dir) > 0): # In case mean_angle = [0,0,1]
-        u_dir = linalg_3.cross(mean_angle,np.array([0,1,0]))
-    u_dir = u_dir / norm(u_dir)
-    v_dir = linalg_3.cross(mean_angle, u_dir)
-    u_proj = my_dot(angles_for_pmt, u_dir)
-
-    u_var = np.var(u_proj)
-    v_proj = my_dot(angles_for_pmt, v_dir)
-    v_var = np.var(v_proj)
-    variance = (u_var+v_var)/2.
-
-    return mean_angle, variance, u_var - v_var
+def _grouped_pmt_calibration(angles, order, offsets, n_min, ddof, mean_angles, variances, u_minus_v):
+    # Segmented reduction over the CSR grouping: for each PMT, the mean direction,
+    # then the variance of the projections on a pair of axes orthogonal to it
+    for pmt in range(len(offsets)-1):
+        start = offsets[pmt]
+        stop = offsets[pmt+1]
+        n_angles = stop - start
+        # skipping pmts with <2 photon hits (in which case the variance will be undefined with ddof=1)
+        # also skipping if <n_min photon hits
+        if n_angles < 2 or n_angles < n_min:
+            continue
+
+        mean = np.zeros(3)
+        for k in range(start, stop):
+            for j in range(3):
+                mean[j] += angles[order[k], j]
+        mean_angle = mean / norm(mean)
+
+        u_dir = linalg_3.cross(mean_angle,np.array([0.,0.,1.]))
+        if not (np.dot(u_dir, u_dir) > 0): # In case mean_angle = [0,0,1]
+            u_dir = linalg_3.cross(mean_angle,np.array([0.,1.,0.]))
+        u_dir = u_dir / norm(u_dir)
+        v_dir = linalg_3.cross(mean_angle, u_dir)
+
+        u_sum = 0.
+        u_sq_sum = 0.
+        v_sum = 0.
+        v_sq_sum = 0.
+        for k in range(start, stop):
+            angle = angles[order[k]]
+            u_proj = linalg_3.dot(angle, u_dir)
+            v_proj = linalg_3.dot(angle, v_dir)
+            u_sum += u_proj
+            u_sq_sum += u_proj*u_proj
+            v_sum += v_proj
+            v_sq_sum += v_proj*v_proj
+        u_var = (u_sq_sum - u_sum*u_sum/n_angles)/(n_angles - ddof)
+        v_var = (v_sq_sum - v_sum*v_sum/n_angles)/(n_angles - ddof)
+
+        mean_angles[pmt] = mean_angle
+        variances[pmt] = (u_var+v_var)/2.
+        u_minus_v[pmt] = u_var - v_var
+
+def compute_grouped_calibration(end_direction_array, order, offsets, n_min, ddof=0):
+    # Returns the mean angle, the average u/v variance and the u-v variance difference
+    # for every PMT, from photons grouped with group_photons_by_pmt()
+    npmt_bins = len(offsets) - 1
+    mean_angles = np.zeros((npmt_bins, 3))
+    variances = np.zeros(npmt_bins)
+    u_minus_v = np.zeros(npmt_bins)
+    _grouped_pmt_calibration(end_direction_array, order, offsets, n_min, ddof, mean_angles, variances, u_minus_v)
+    return mean_angles, variances, u_minus_v
+
+# Calibration shared with the forked worker processes of a sharded calibration: (DetectorResponseGaussAngle, simname)
+_shard_calibration = None
+
+def _accumulate_shard(event_range):
+    det_res, simname = _shard_calibration
+    det_res.query_threads = 1     # The workers already use every core
+    return det_res._accumulate_events(simname, event_range[0], event_range[1])
+
+def split_event_range(first, last, n_shards):
+    # Contiguous (first, last) event ranges covering range(first, last)
+    bounds = np.linspace(first, last, min(n_shards, last-first)+1).astype(int)
+    return [(int(bounds[i]), int(bounds[i+1])) for i in range(len(bounds)-1)]
 
 class DetectorResponseGaussAngle(DetectorResponse):
     '''Detector calibration information is stored in Gaussian cones for each PMT: 
     the cones are represented as mean angles in 3D space and their uncertainties 
     (sigma for a cone of unit length) for the light hitting that PMT.
     '''
-    def __init__(self, config, detectorxbins=10, detectorybins=10, detectorzbins=10, infile=None):
+    def __init__(self, config, detectorxbins=10, detectorybins=10, detectorzbins=10, infile=None, binning='kdtree', compact=False,
+                 geometry='mesh', geometry_cache=True, query_threads=1):
         # If passed infile, will automatically read in the calibrated detector mean angles/sigmas
-        DetectorResponse.__init__(self, config, detectorxbins, detectorybins, detectorzbins)
-        self.means = np.zeros((3,self.npmt_bins))
-        self.sigmas = np.zeros(self.npmt_bins)
+        DetectorResponse.__init__(self, config, detectorxbins, detectorybins, detectorzbins, binning=binning, geometry_cache=geometry_cache,
+                                  geometry=geometry, query_threads=query_threads, compact=compact)
+        self.means = np.zeros((3,self.npmt_bins), dtype=self.float_dtype)
+        self.sigmas = np.zeros(self.npmt_bins, dtype=self.float_dtype)
+        # Per-PMT sums behind the means and sigmas, and the simulation files they came from (see update_calibration())
+        self.calibration_statistics = None
+        self.calibration_ddof = 0
+        self.simulation_files = []
+        self.simulation_hashes = []     # Content hashes of the simulation files (see simulation_reader.content_hash())
+        self.calibration_events = None  # Events in the sums, over all of the simulation files
+        self.lens_symmetric = False     # True if the sums are per pixel of a single lens system (see calibrate())
+        self.ring_symmetric = False     # True if the sums are per ring of a single lens system
+        self.ring_means = None          # Ring calibration model: (n_rings, 3) mean angle and (n_rings,) sigma
+        self.ring_sigmas = None         # for the pixel at zero azimuth in each ring (see calibrate())
+        self.target_precision = None    # Precision calibrated to, and the PMTs which did not reach it (see calibrate())
+        self.unconverged_pmts = None
         if infile is not None:
             logger.info('Creating detector response / calibration with: %s' % infile)
             if infile.endswith('.h5'):
@@ -107,14 +159,72 @@ class DetectorResponseGaussAngle(DetectorResponse):
         end_direction_array[n_det:(n_det+length),:] = end_dir
         return ending_photons, length
 
+    def _photon_directions(self, photons_beg_pos, photons_end_pos, detected):
+        # Returns the PMT hit by each detected photon and the direction from the center of
+        # the lens it came through back to its origin.  Photons that could not be associated
+        # to a PMT are dropped from both arrays so that they stay aligned.
+        beginning_photons = photons_beg_pos[detected]       # Include reflected photons
+        ending_photons = photons_end_pos[detected]
+        pmt_b, lenses, _, _ = self._pmt_arr_surf(ending_photons)
+        good_bins = pmt_b < self.npmt_bins
+        end_point = self.lens_centers[lenses[good_bins]]
+        end_dir = normalize(end_point-beginning_photons[good_bins]).astype(self.float_dtype, copy=False)
+        return pmt_b[good_bins], end_dir
+
+    def _validate_binning(self, simname):
+        # Check the binning against the full KD-tree on the hits of the first event of the simulation
+        _, event_source = self._simulation_events(simname, 0, 1)
+        for photons_beg, photons_end in event_source:
+            detected = (photons_end.flags & (0x1 <<2)).astype(bool)
+            _, mismatch = self.validate_binning(photons_end.pos[detected])
+            if mismatch > BINNING_MISMATCH:
+                logger.warning('%s binning puts %f of the hits away from the KD-tree pixel or its neighbors' % (self.binning, mismatch))
+
+    def _simulation_events(self, simname, first=0, last=None):
+        # Returns the number of events in the simulation file 'simname' and an iterator
+        # over (photons_beg, photons_end) for its events in range(first, last)
+        # hdf5 files are read a few events at a time (see simulation_reader)
+        # TODO: Check the UUID!!
+        events_in_file = simulation_reader.count_events(simname)
+        logger.info('Opened simulation file: %s' % simname)
+        logger.info('Simulation event count: %d' % events_in_file)
+        return events_in_file, simulation_reader.iterate_events(simname, first, last)
+
     '''
     The calibration is performed in three steps:
-    1. Loop over events to find the pmt that each photon hit, and the direction for each photon.  Produces file 'hits-config.pickle'
-    2. Loop over all photons to gather them by pmt.  Produces file 'pmt-bins.config.pickle'
+    1. Loop over events to find the pmt that each photon hit, and the direction for each photon.  Produces file '<config>-hits.h5',
+       which is reused instead of repeating this step as long as the simulation file contents, configuration, binning and nevents
+       match (e.g. to recalibrate with another n_min).  Only this in-memory calibration reads and writes it: the streaming modes
+       below bin every photon again.
+    2. Loop over all photons to gather them by pmt.  Produces file '<config>-pmt-bins.h5' (fast calibration)
     3. Loop over all photons for each pmt to compute statistics for each pmt
-    The files are only meant to preserve the intermediate state.  They are not required.
+    The files are only meant to preserve the intermediate state (and the hits).  They are not required.
+    With streaming=True, steps 1 and 2 are replaced by per-PMT running sums (see CalibrationAccumulator)
+    which are folded in one event at a time, so no photon list is ever stored.
+    With workers > 1 the streaming calibration is split by event range across a process pool, and
+    the partial sums from each worker are merged before computing the statistics.
+    With checkpoint_interval > 0, the state is saved every checkpoint_interval events in 'directory', and a later
+    call with the same configuration and simulation file resumes from the last checkpoint: the hits collected so
+    far in '<config>-hits-checkpoint.h5' (step 1), or the running sums in '<config>-calibration-checkpoint.h5'
+    when streaming.
+    With target_precision set (which also implies streaming), nevents is only an upper limit: reading stops
+    as soon as converged_fraction of the PMTs have at least n_min hits and a relative standard error on
+    sigma of at most target_precision.  The fraction is over the PMTs with hits: PMTs that are never lit (dead or
+    occluded pixels) can never converge.  The PMTs which never get there, lit or not, are kept in self.unconverged_pmts
+    and saved with the target precision by write_to_hdf5().
+    With lens_symmetric=True (which also implies streaming), every lens system is treated as the same
+    assembly rotated into place: each photon direction is rotated into the frame of the lens system it hit,
+    the sums are kept per pixel of one lens system (n_lens_sys times the statistics per pixel), and the
+    mean angles are rotated back out to every lens system.  The sigmas are then the same for every lens system.
+    With ring_symmetric=True (which implies lens_symmetric), the rotational symmetry of the curved surface
+    is used as well: directions are also rotated about the lens axis by the azimuth of the pixel hit, and the
+    sums are kept per ring.  The calibration is then one mean angle and sigma per ring (self.ring_means,
+    self.ring_sigmas), and the mean angle of each pixel is that of its ring rotated to the pixel azimuth.
+    Either way, the per-PMT sums are kept in self.calibration_statistics and saved by write_to_hdf5(),
+    so that update_calibration() can later fold in more simulation files.
     '''
-    def calibrate(self, simname, directory=".", nevents=-1, fast_calibration=False):
+    def calibrate(self, simname, directory=".", nevents=-1, fast_calibration=False, streaming=False, n_min=10, workers=1, checkpoint_interval=0,
+                  target_precision=None, converged_fraction=0.95, lens_symmetric=False, ring_symmetric=False):
         # Use with a simulation file 'simname' to calibrate the detector
         # Creates a list of mean angles and their uncertainties (sigma for
         # a cone of unit length), one for each PMT
@@ -122,276 +232,507 @@ class DetectorResponseGaussAngle(DetectorResponse):
         # Uses all photons hitting a given PMT at once (better estimate of sigma,
         # but may run out of memory in some cases).
         # Will not calibrate PMTs with <n_min hits
-        logger.info('Fast calibration: %s' % str(fast_calibration))
+        lens_symmetric = lens_symmetric or ring_symmetric
+        logger.info('Fast calibration: %s, streaming: %s, workers: %d, checkpoint interval: %d, lens symmetric: %s, ring symmetric: %s' %
+                    (str(fast_calibration), str(streaming), workers, checkpoint_interval, str(lens_symmetric), str(ring_symmetric)))
         self.is_calibrated = True
+        self.calibration_ddof = 0 if fast_calibration else 1      # The slow calibration keeps its unbiased variance estimate
+        simulation_hash = simulation_reader.content_hash(simname)
+        self.simulation_files = [os.path.basename(simname)]
+        self.simulation_hashes = [simulation_hash]
+        self.lens_symmetric = lens_symmetric
+        self.ring_symmetric = ring_symmetric
+        self.target_precision = target_precision
+        self.unconverged_pmts = None
         start_time = time.time()
+        if self.binning != 'kdtree':
+            self._validate_binning(simname)
+
+        if streaming or workers > 1 or target_precision is not None or lens_symmetric:
+            if lens_symmetric:
+                lens_distances = np.linalg.norm(self.config.vtx, axis=1)
+                if np.ptp(lens_distances) > 1e-6*np.max(lens_distances):
+                    logger.warning('Lens systems are not all at the same distance from the center: lens symmetric calibration is approximate')
+            checkpoint_file = directory + self.configname + '-calibration-checkpoint.h5' if checkpoint_interval > 0 else None
+            logger.info('Streaming calibration: not using the hits file (in-memory calibration only)')
+            # The slow calibration keeps its unbiased (ddof=1) variance estimate
+            self._calibrate_streaming(simname, nevents, n_min, workers, ddof=self.calibration_ddof,
+                                      checkpoint_file=checkpoint_file, checkpoint_interval=checkpoint_interval,
+                                      target_precision=target_precision, converged_fraction=converged_fraction)
+            return
+
+        # The hits only depend on the simulation file, the detector configuration and the number of events,
+        # so they are kept in '<config>-hits.h5' and reused by later calibrations (e.g. with another n_min)
+        hits_file = directory + self.configname + '-hits.h5'
+        events_in_file = simulation_reader.count_events(simname)
+        if nevents < 1 or nevents > events_in_file:
+            nevents = events_in_file
+        cached_hits = self._read_hits_cache(hits_file, simulation_hash, nevents)
+        if cached_hits is not None:
+            pmt_bins, end_direction_array = cached_hits
+        else:
+            checkpoint_file = directory + self.configname + '-hits-checkpoint.h5' if checkpoint_interval > 0 else None
+            pmt_bins, end_direction_array = self._collect_hits(simname, nevents, fast_calibration, checkpoint_file, checkpoint_interval, simulation_hash)
+            self._write_hits_cache(hits_file, simulation_hash, nevents, pmt_bins, end_direction_array)
+            if checkpoint_file is not None and os.path.exists(checkpoint_file):
+                os.remove(checkpoint_file)   # Superseded by the hits file
 
-        base_hits_file_name = self.configname + '-hits'
-        pickle_name = base_hits_file_name + '.pickle'
-        hit_file_exists = False
-        n_min = 10 # Do not calibrate a PMT if <n_min photons hit it
-        try:
-            logger.info('Attempting to load pickle hits file: %s%s' % (directory, pickle_name));      # TODO: This generally won't do anything because we no longer write this file
-            with open(directory + pickle_name, 'rb') as inf:
-                pmt_hits = pickle.load(inf)
-            logger.info('Hit map pickle file loaded: ' + pickle_name)
-            pmt_bins = pmt_hits['pmt_bins']
-            end_direction_array = pmt_hits['end_direction_array']
-            n_det = len(pmt_bins)
-            hit_file_exists = True
-        except IOError as error:
-            # Assume file not found
-            logger.info('Hit map pickle file not found.  Creating: ' + base_hits_file_name)
-
-            using_h5 = False
-            if simname.endswith('.h5'):
-                using_h5 = True
-                ev_file = dd.io.load(simname)
-                # TODO: Check the UUID!!
-                events_in_file = len(ev_file['photons_start'])
-            else:
-                from ShortIO.root_short import GaussAngleRootWriter, GaussAngleRootReader, ShortRootReader
-                reader = ShortRootReader(simname)
-                events_in_file = len(reader)
-            logger.info('Loaded simulation file: %s' % simname)
-            logger.info('Simulation event count: %d' % events_in_file)
-
-            if nevents < 1:
-                nevents = events_in_file
-
-            max_storage = min(nevents*1000000,120000000) #600M is too much, 400M is OK (for np.float32; using 300M)
-            end_direction_array = np.empty((max_storage,3),dtype=np.float32)
-            pmt_bins = np.empty(max_storage,dtype=np.int)
-            n_det = 0
-
-            # Loop through events, store for each photon the index of the PMT it hit (pmt_bins)
-            # and the direction pointing back to its origin (end_direction_array)
-            loops = 0
-            event_source = ev_file['photons_start'] if using_h5 else reader
-            for index, ev_proxy in enumerate(event_source):  # Not sure if we can enumerate a reader????
-                # TODO: This needs to be cleaned up
-                if (using_h5):
-                    photons_beg = Photons(ev_proxy, [], [], [])
-                    photons_end = Photons(ev_file['photons_stop'][index], [], [], [], flags=ev_file['photon_flags'][index])
-                else:
-                    photons_beg = ev_proxy.photons_beg
-                    photons_end = ev_proxy.photons_end
-
-                loops += 1
-                if loops > nevents:
-                    break
-
-                if loops % 100 == 0:
-                    logger.info("Event " + str(loops) + " of " + str(nevents))
-                    logger.handlers[0].flush()
-
-                detected = (photons_end.flags & (0x1 <<2)).astype(bool)
-                '''
-                reflected_diffuse = (ev.photons_end.flags & (0x1 << 5)).astype(bool)
-                reflected_specular = (ev.photons_end.flags & (0x1 << 6)).astype(bool)
-                logger.info("Total detected: " + str(sum(detected * 1)))
-                logger.info("Total reflected: " + str(sum(reflected_diffuse * 1) + sum(reflected_specular * 1)))
-                good_photons = detected & np.logical_not(reflected_diffuse) & np.logical_not(reflected_specular)
-                logger.info("Total detected and not reflected: " + str(sum(good_photons * 1)))
-                '''
-                if fast_calibration: 
-                    ending_photons, length = self._find_photons_for_pmt(photons_beg.pos, photons_end.pos, detected,
-                                                                       end_direction_array, n_det, max_storage)
-                    pmt_b = self.find_pmt_bin_array(ending_photons)
-                    if length is None:
-                        break
-                else:
-                    beginning_photons = photons_beg.pos[detected] # Include reflected photons
-                    ending_photons = photons_end.pos[detected]
-                    length = np.shape(ending_photons)[0]
-                    pmt_b = self.find_pmt_bin_array(ending_photons)
-                    end_point = self.lens_centers[pmt_b/self.n_pmts_per_surf]
-                    end_dir = normalize(end_point-beginning_photons)
-                    # if end_direction_array is None:
-                    #     end_direction_array = end_dir
-                    # else:
-                    #     end_direction_array = np.vstack((end_direction_array, end_dir))
-                    #end_direction_array.append(end_dir)
-                    if n_det+length > max_storage:
-                        logger.info('Too many photons to store in memory; not reading any further events.')
-                        break
-                    end_direction_array[n_det:(n_det+length),:] = end_dir
-                    # if pmt_bins is None:
-                    #     pmt_bins = pmt_b
-                    # else:
-                    #     pmt_bins = np.hstack((pmt_bins, pmt_b))
-                    #pmt_bins.append(pmt_b)
-                pmt_bins[n_det:(n_det+length)] = pmt_b
-                n_det += length
-                if loops % 100 == 0:
-                    logger.info('Photons detected so far: ' + str(n_det + length))
-                    # logger.info('Sample pmt bins: ' + str(pmt_bins[n_det:(n_det+length)]))
-                    logger.info("Time: " + str(time.time() - start_time))
-
-        total_means = np.zeros((self.npmt_bins, 3))
-        total_variances = np.zeros((self.npmt_bins))
-        total_u_minus_v = np.zeros((self.npmt_bins))
-        amount_of_hits = np.zeros((self.npmt_bins))
-
-        end_direction_array.resize((n_det,3))
-        logger.info("Time: " + str(time.time() - start_time))
-        pmt_bins.resize(n_det)
-
-        if not hit_file_exists:
-			# TODO: No longer writing the pickle file
-            # Write the pickle hits file regardless of whether using fast_calibration or not
-            #pmt_hits = {'pmt_bins': pmt_bins, 'end_direction_array': end_direction_array}
-            #with open(directory+pickle_name, 'wb') as outf:
-            #    pickle.dump(pmt_hits, outf)
-            with h5py.File(directory + base_hits_file_name + '.h5', 'w') as h5file:
-                _ = h5file.create_dataset('pmt_bins', data=pmt_bins, chunks=True)   # TODO: Should we assign max shape?
-                _ = h5file.create_dataset('end_direction_array', data=end_direction_array, chunks=True)   # TODO: Should we assign max shape?
-            logger.info('Hit map file created: ' + pickle_name)
-
-        logger.info("Finished collecting photons (or loading photon hit list).  Time: " + str(time.time()-start_time))
+        logger.info("Finished collecting photons.  Time: " + str(time.time()-start_time))
 
+        # Gather the photons by PMT with a single sort (CSR offsets into the sorted photon order)
+        order, offsets = group_photons_by_pmt(self.npmt_bins, pmt_bins)
         if fast_calibration:
             bins_base_file_name = self.configname + '-pmt-bins'
-            bins_pickle_file = bins_base_file_name + '.pickle'
-            try:
-                with open(directory + bins_pickle_file, 'rb') as inf:       # TODO: This generally won't do anything because we no longer write this file
-                    pmt_photons = pickle.load(inf)
-                logger.info('PMT photon list pickle file loaded: ' + bins_pickle_file)
-            except IOError as error:
-                start_assign = time.time()
-                pmt_photons = assign_photons(self.npmt_bins, n_det, pmt_bins)
-                logger.info("assign_photons took: " + str(time.time() - start_assign))
-				# TODO: No longer writing the pickle file
-                #with open(directory + bins_pickle_file, 'wb') as outf:
-                #    pickle.dump(pmt_photons, outf)
-
-				# TODO: Pure H5 does not work.  (Because?)
-                #with h5py.File(directory + bins_file + '.h5', 'w') as h5file:
-                #    _ = h5file.create_dataset('photon_pmts', data=pmt_photons, chunks=True)   # Should we assign max shape?
-                #logger.info('Type: ' + str(type(pmt_photons)) + ' ' + str(type(pmt_photons[0])))
-                dd.io.save(directory + bins_base_file_name + '.h5', pmt_photons)
-                logger.info('PMT photon list file created: ' + bins_base_file_name + '.h5')
+            with h5py.File(directory + bins_base_file_name + '.h5', 'w') as h5file:
+                _ = h5file.create_dataset('photon_order', data=order, chunks=True)
+                _ = h5file.create_dataset('pmt_offsets', data=offsets, chunks=True)
+            logger.info('PMT photon list file created: ' + bins_base_file_name + '.h5')
 
         logger.info("Finished listing photons by pmt.  Time: " + str(time.time() - start_time))
 
-        draw_pmt_ind = -1
+        # Compute a mean_angle and a variance for every pmt in one pass over the grouped photons
+        total_means, total_variances, total_u_minus_v = compute_grouped_calibration(end_direction_array, order, offsets, n_min,
+                                                                                   ddof=self.calibration_ddof)
+        # Keep the per-PMT sums as well, so that the calibration can be extended later
+        self.calibration_statistics = CalibrationAccumulator(self.npmt_bins)
+        good_bins = pmt_bins < self.npmt_bins
+        self.calibration_statistics.add(pmt_bins[good_bins], end_direction_array[good_bins])
+        total_u_minus_v = np.abs(total_u_minus_v)
+        amount_of_hits = np.diff(offsets)
+        amount_of_hits[(amount_of_hits < 2) | (amount_of_hits < n_min)] = 0     # Count only the calibrated PMTs
+        if np.any(np.isnan(total_variances)):
+            print "Nan for PMTs " + str(np.where(np.isnan(total_variances))[0])
+        logger.info("Finished computing PMT statistics.  Time: " + str(time.time() - start_time))
+
+        self.calibration_events = nevents
+        self._store_calibration(total_means, total_variances, total_u_minus_v, amount_of_hits, nevents, n_min)
+
+    def _collect_hits(self, simname, nevents, fast_calibration, checkpoint_file=None, checkpoint_interval=0, simulation_hash=None):
+        # Returns the PMT hit by each detected photon in the first nevents events of simname,
+        # and the direction pointing back to its origin
+        # With a checkpoint_file, the hits are also appended to it every checkpoint_interval events,
+        # and collection resumes after the events already in it
+        start_time = time.time()
 
-        # looping through each pmt in order to save a mean_angle and a variance
-        for i in range(self.npmt_bins):
-            if i % 10000 == 0:
-                logger.info(str(i) + ' out of ' + str(self.npmt_bins) + ' PMTs')
+        max_storage = min(nevents*1000000,120000000) #600M is too much, 400M is OK (for np.float32; using 300M)
+        end_direction_array = np.empty((max_storage,3),dtype=np.float32)
+        pmt_bins = np.empty(max_storage,dtype=self.pmt_dtype)
+        n_det = 0
+
+        # Loop through events, store for each photon the index of the PMT it hit (pmt_bins)
+        # and the direction pointing back to its origin (end_direction_array)
+        loops = 0
+        if checkpoint_file is not None:
+            loops, n_det = self._read_hits_checkpoint(checkpoint_file, simulation_hash, nevents, pmt_bins, end_direction_array)
+        last_checkpoint, n_checkpointed = loops, n_det
+        _, event_source = self._simulation_events(simname, loops)
+        for photons_beg, photons_end in event_source:
+            loops += 1
+            if loops > nevents:
+                break
+
+            if loops % 100 == 0:
+                logger.info("Event " + str(loops) + " of " + str(nevents))
                 logger.handlers[0].flush()
-                logger.info("Time: " + str(time.time()-start_time))
-
-            if fast_calibration:
-                photon_list = pmt_photons[i]
-                angles_for_pmt = end_direction_array[photon_list]
-                n_angles = len(angles_for_pmt)  # np.shape(angles_for_pmt)[0]
-                # skipping pmts with <2 photon hits (in which case the variance will be undefined with ddof=1)
-                # also skipping if <n_min photon hits
-                if n_angles < 2 or n_angles < n_min:
-                    logger.warning('Not enough angles for PMT: %d, %d' % (i, n_angles))
-                    continue
 
-                mean_angle, variance, uvvar = compute_pmt_calibration(angles_for_pmt, n_min)
+            detected = (photons_end.flags & (0x1 <<2)).astype(bool)
+            '''
+            reflected_diffuse = (ev.photons_end.flags & (0x1 << 5)).astype(bool)
+            reflected_specular = (ev.photons_end.flags & (0x1 << 6)).astype(bool)
+            logger.info("Total detected: " + str(sum(detected * 1)))
+            logger.info("Total reflected: " + str(sum(reflected_diffuse * 1) + sum(reflected_specular * 1)))
+            good_photons = detected & np.logical_not(reflected_diffuse) & np.logical_not(reflected_specular)
+            logger.info("Total detected and not reflected: " + str(sum(good_photons * 1)))
+            '''
+            if fast_calibration: 
+                ending_photons, length = self._find_photons_for_pmt(photons_beg.pos, photons_end.pos, detected,
+                                                                   end_direction_array, n_det, max_storage)
+                pmt_b = self.find_pmt_bin_array(ending_photons)
+                if length is None:
+                    break
             else:
-                pmt_indices = np.where(pmt_bins == i)[0]
-                if np.shape(pmt_indices)[0] == 0:
-                    continue
-                angles_for_pmt = end_direction_array[pmt_indices]
+                beginning_photons = photons_beg.pos[detected] # Include reflected photons
+                ending_photons = photons_end.pos[detected]
+                length = np.shape(ending_photons)[0]
+                pmt_b = self.find_pmt_bin_array(ending_photons)
+                end_point = self.lens_centers[pmt_b/self.n_pmts_per_surf]
+                end_dir = normalize(end_point-beginning_photons)
+                # if end_direction_array is None:
+                #     end_direction_array = end_dir
+                # else:
+                #     end_direction_array = np.vstack((end_direction_array, end_dir))
+                #end_direction_array.append(end_dir)
+                if n_det+length > max_storage:
+                    logger.info('Too many photons to store in memory; not reading any further events.')
+                    break
+                end_direction_array[n_det:(n_det+length),:] = end_dir
+                # if pmt_bins is None:
+                #     pmt_bins = pmt_b
+                # else:
+                #     pmt_bins = np.hstack((pmt_bins, pmt_b))
+                #pmt_bins.append(pmt_b)
+            pmt_bins[n_det:(n_det+length)] = pmt_b
+            n_det += length
+            if loops % 100 == 0:
+                logger.info('Photons detected so far: ' + str(n_det + length))
+                # logger.info('Sample pmt bins: ' + str(pmt_bins[n_det:(n_det+length)]))
+                logger.info("Time: " + str(time.time() - start_time))
+            if checkpoint_file is not None and loops < nevents and loops - last_checkpoint >= checkpoint_interval:
+                self._write_hits_checkpoint(checkpoint_file, simulation_hash, pmt_bins, end_direction_array, n_checkpointed, n_det, loops,
+                                            create=(last_checkpoint == 0))
+                last_checkpoint, n_checkpointed = loops, n_det
 
-                n_angles = np.shape(angles_for_pmt)[0]
-                #skipping pmts with <2 photon hits (in which case the variance will be undefined with ddof=1)
-                #also skipping if <n_min photon hits
-                if n_angles < 2 or n_angles<n_min:
-                    continue
-                mean_angle = normalize(np.mean(angles_for_pmt, axis=0))
+        end_direction_array.resize((n_det,3))
+        logger.info("Time: " + str(time.time() - start_time))
+        pmt_bins.resize(n_det)
+        return pmt_bins, end_direction_array
 
-                # For each PMT, get a pair of axes which form an
-                # orthonormal coordinate system with the PMT mean direction
-                u_dir = np.cross(mean_angle,np.array([0,0,1]))
-                if not (np.dot(u_dir, u_dir) > 0): # In case mean_angle = [0,0,1]
-                    u_dir = np.cross(mean_angle,np.array([0,1,0]))
-                u_dir = normalize(u_dir)
-                v_dir = np.cross(mean_angle, u_dir)
-
-                u_proj = np.dot(angles_for_pmt, u_dir)
-                u_var = np.var(u_proj, ddof=1)
-                v_proj = np.dot(angles_for_pmt, v_dir)
-                v_var = np.var(v_proj, ddof=1)
-                variance = (u_var+v_var)/2.
-
-                # Old method, which calculated variance of projected norma, even though
-                # the mean of the projections wasn't 0 due to the solid angle factor
-                norms = np.repeat(1.0, n_angles)
-                projection_norms = np.dot(angles_for_pmt, mean_angle)
-                orthogonal_complements = np.sqrt(np.maximum(norms**2 - projection_norms**2, 0.))
-                #variance = np.var(orthogonal_complements, ddof=1)
-
-                uvvar = u_var - v_var
-            try:
-                #draw_pmt_ind = None
-                draw_pmt_ind = int(draw_pmt_ind)
-                '''
-                if i == draw_pmt_ind or draw_pmt_ind<0:
-                    # Temporary, to visualize histogram of angles, distances
-                    #angles = np.arccos(projection_norms)
-                    #ang_variance = np.var(angles, ddof=1)
-                    #fig1 = plt.figure(figsize=(7.8, 6))
-                    #plt.hist(angles, bins=20)
-                    #plt.xlabel('Angular Separation to Mean Angle')
-                    #plt.ylabel('Counts per bin')
-                    #plt.title('Angles Histogram for PMT ' + str(i))
-                    ##plt.show()
-                    #
-                    #fig2 = plt.figure(figsize=(7.8, 6))
-                    #plt.hist(angles, bins=20, weights=1./np.sin(angles))
-                    #plt.xlabel('Angular Separation to Mean Angle')
-                    #plt.ylabel('Counts per solid angle')
-                    #plt.title('Angles Histogram for PMT ' + str(i))
-
-                    fig3 = plt.figure(figsize=(7.8, 6))
-                    plt.hist(orthogonal_complements, bins=20)
-                    plt.xlabel('Normalized Distance to Mean Angle')
-                    plt.ylabel('Counts per bin')
-                    plt.title('Distances Histogram for PMT ' + str(i))
-
-                    fig4 = plt.figure(figsize=(7.8, 6))
-                    plt.hist(u_proj, bins=20)
-                    plt.xlabel('U Distance to Mean Angle')
-                    plt.ylabel('Counts per bin')
-                    plt.title('U Distances Histogram for PMT ' + str(i))
-
-                    fig5 = plt.figure(figsize=(7.8, 6))
-                    plt.hist(v_proj, bins=20)
-                    plt.xlabel('V Distance to Mean Angle')
-                    plt.ylabel('Counts per bin')
-                    plt.title('V Distances Histogram for PMT ' + str(i))
-                    plt.show()
-
-                    #print "Average projected variance: ", variance
-                    #print "Variance of projected 2D norms: ", np.var(orthogonal_complements, ddof=1)
-                    draw_pmt_ind = raw_input("Enter index of next PMT to draw; will stop drawing if not a valid PMT index.\n")
-                '''
-            except ValueError:
-                pass
-            except TypeError:
-                pass
-
-            total_means[i] = mean_angle
-            total_variances[i] = variance
-            total_u_minus_v[i] = np.abs(uvvar)
-            amount_of_hits[i] = n_angles
-            if np.isnan(variance):
-                print "Nan for PMT " + str(i)
-                # nan_ind = np.where(np.isnan(orthogonal_complements))
-                # print nan_ind
-                # print projection_norms
-                # print orthogonal_complements
-                # print angles_for_pmt
-                # print variance
-                # print mean_angle
+    def _binning_attrs(self):
+        # How the hits were binned: the pixel ids of the binning methods differ for some hits (see validate_binning()),
+        # so hits, checkpoints and calibrations record the method, and the dtype of the PMT ids
+        return {'binning': self.binning, 'pmt_dtype': np.dtype(self.pmt_dtype).name}
+
+    def _same_binning(self, attrs):
+        # True if attrs (of a hits file or checkpoint) were written with the binning and PMT id dtype of this detector response
+        return all(attrs.get(key) == value for key, value in self._binning_attrs().items())
+
+    def _read_hits_cache(self, hits_file, simulation_hash, nevents):
+        # Returns (pmt_bins, end_direction_array) from a hits file made from the same simulation file
+        # contents, configuration and number of events, or None
+        if not os.path.exists(hits_file):
+            return None
+        with h5py.File(hits_file, 'r') as h5file:
+            if h5file.attrs.get('config_UUID') != str(self.config.uuid) or h5file.attrs.get('simulation_hash') != simulation_hash \
+                    or h5file.attrs.get('events') != nevents:
+                logger.info('Hit map file %s is for another configuration, simulation file or event count.  Not using it.' % hits_file)
+                return None
+            if not self._same_binning(h5file.attrs):
+                logger.info('Hit map file %s was binned with %s (%s PMT ids), not %s (%s).  Not using it.' %
+                            (hits_file, h5file.attrs.get('binning'), h5file.attrs.get('pmt_dtype'), self.binning, np.dtype(self.pmt_dtype).name))
+                return None
+            pmt_bins = h5file['pmt_bins'][()]
+            end_direction_array = h5file['end_direction_array'][()]
+        logger.info('Using hit map file: %s (%d photons)' % (hits_file, len(pmt_bins)))
+        return pmt_bins, end_direction_array
+
+    def _write_hits_cache(self, hits_file, simulation_hash, nevents, pmt_bins, end_direction_array):
+        # Write to a temporary file and rename, so an interrupted write never leaves a partial cache
+        temp_file = hits_file + '.tmp'
+        with h5py.File(temp_file, 'w') as h5file:
+            h5file.attrs['config_UUID'] = str(self.config.uuid)
+            h5file.attrs['simulation_hash'] = simulation_hash
+            h5file.attrs['events'] = nevents
+            h5file.attrs.update(self._binning_attrs())
+            h5file.create_dataset('pmt_bins', data=pmt_bins, chunks=True, compression='gzip', shuffle=True)
+            h5file.create_dataset('end_direction_array', data=end_direction_array, chunks=True, compression='gzip', shuffle=True)
+        os.rename(temp_file, hits_file)
+        logger.info('Hit map file created: ' + hits_file)
+
+    def _write_hits_checkpoint(self, checkpoint_file, simulation_hash, pmt_bins, end_direction_array, first, last, events_done, create=False):
+        # Append the hits in [first, last) to the checkpoint file (a new one if create), so each checkpoint only writes the
+        # hits since the previous one.  The photon and event counts are updated last: hits past them are ignored on resume.
+        with h5py.File(checkpoint_file, 'w' if create else 'a') as h5file:
+            if create:
+                h5file.attrs['config_UUID'] = str(self.config.uuid)
+                h5file.attrs['simulation_hash'] = simulation_hash
+                h5file.attrs.update(self._binning_attrs())
+                h5file.create_dataset('pmt_bins', shape=(0,), maxshape=(None,), dtype=pmt_bins.dtype, chunks=True)
+                h5file.create_dataset('end_direction_array', shape=(0,3), maxshape=(None,3), dtype=end_direction_array.dtype, chunks=True)
+            for name, hits in (('pmt_bins', pmt_bins), ('end_direction_array', end_direction_array)):
+                dataset = h5file[name]
+                dataset.resize(last, axis=0)
+                dataset[first:last] = hits[first:last]
+            h5file.attrs['photons'] = last
+            h5file.attrs['events_consumed'] = events_done
+        logger.info('Hits checkpoint written: %s (%d events)' % (checkpoint_file, events_done))
+
+    def _read_hits_checkpoint(self, checkpoint_file, simulation_hash, nevents, pmt_bins, end_direction_array):
+        # Reads the hits of a matching checkpoint into the start of pmt_bins and end_direction_array.
+        # Returns the number of events and photons read, or (0, 0).
+        if not os.path.exists(checkpoint_file):
+            return 0, 0
+        try:
+            with h5py.File(checkpoint_file, 'r') as h5file:
+                if h5file.attrs.get('config_UUID') != str(self.config.uuid) or h5file.attrs.get('simulation_hash') != simulation_hash \
+                        or not self._same_binning(h5file.attrs):
+                    logger.warning('Hits checkpoint %s does not match this configuration, simulation file and binning.  Ignoring it.' % checkpoint_file)
+                    return 0, 0
+                events_done = int(h5file.attrs['events_consumed'])
+                n_det = int(h5file.attrs['photons'])
+                if events_done > nevents or n_det > len(pmt_bins):
+                    logger.warning('Hits checkpoint %s has more events than requested.  Ignoring it.' % checkpoint_file)
+                    return 0, 0
+                pmt_bins[:n_det] = h5file['pmt_bins'][:n_det]
+                end_direction_array[:n_det] = h5file['end_direction_array'][:n_det]
+        except (IOError, KeyError) as error:
+            logger.warning('Unable to read hits checkpoint %s: %s.  Ignoring it.' % (checkpoint_file, str(error)))
+            return 0, 0
+        logger.info('Resuming hit collection from checkpoint: %s (%d events)' % (checkpoint_file, events_done))
+        return events_done, n_det
+
+    def _calibrate_streaming(self, simname, nevents, n_min, workers=1, ddof=0, checkpoint_file=None, checkpoint_interval=0,
+                             target_precision=None, converged_fraction=0.95):
+        # Single pass calibration: each event is folded into per-PMT running sums as it
+        # is read, so memory does not grow with the number of photons consumed.
+        # Gives the same means/sigmas as the in-memory calibration with the same ddof.
+        global _shard_calibration
 
+        start_time = time.time()
+        events_in_file = simulation_reader.count_events(simname)
+        if nevents < 1 or nevents > events_in_file:
+            nevents = events_in_file
+
+        accumulator, events_done = None, 0
+        if checkpoint_file is not None:
+            accumulator, events_done = self._read_checkpoint(checkpoint_file, simname)
+        if accumulator is None:
+            accumulator, events_done = CalibrationAccumulator(self._statistics_bins()), 0
+
+        # The sums are independent across events: with workers > 1, accumulate event ranges
+        # in forked workers, then merge the partial sums in event order
+        pool = None
+        if workers > 1:
+            _shard_calibration = (self, simname)
+            pool = multiprocessing.Pool(workers)
+        # Events are consumed in rounds: up to each checkpoint, and often enough to check the precision
+        round_events = checkpoint_interval if checkpoint_interval > 0 else nevents
+        if target_precision is not None:
+            round_events = min(round_events, PRECISION_CHECK_EVENTS)
+        last_checkpoint = events_done
+        try:
+            while events_done < nevents:
+                round_end = min(nevents, events_done + round_events)
+                if pool is not None:
+                    for partial in pool.map(_accumulate_shard, split_event_range(events_done, round_end, workers)):
+                        accumulator.merge(partial)
+                else:
+                    accumulator.merge(self._accumulate_events(simname, events_done, round_end))
+                events_done = round_end
+                logger.info('Events accumulated: %d of %d.  Time: %s' % (events_done, nevents, str(time.time() - start_time)))
+                if target_precision is not None:
+                    fraction = self._converged_fraction(accumulator, target_precision, n_min)
+                    logger.info('PMTs converged to %g: %f' % (target_precision, fraction))
+                    if fraction >= converged_fraction:
+                        logger.info('Target precision reached after %d of %d events' % (events_done, nevents))
+                        break
+                if checkpoint_file is not None and events_done < nevents and events_done - last_checkpoint >= checkpoint_interval:
+                    self._write_checkpoint(checkpoint_file, simname, accumulator, events_done)
+                    last_checkpoint = events_done
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+                _shard_calibration = None
+
+        logger.info("Finished accumulating photons.  Time: " + str(time.time()-start_time))
+        total_means, total_variances, total_u_minus_v, amount_of_hits = self._pmt_calibration(accumulator, n_min, ddof)
+        self.calibration_events = events_done
+        self._store_calibration(total_means, total_variances, np.abs(total_u_minus_v), amount_of_hits, events_done, n_min)
+        self.calibration_statistics = accumulator
+        if target_precision is not None:
+            self._find_unconverged_pmts(accumulator, n_min, events_done)
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)   # Calibration is complete; nothing left to resume
+
+    def _converged_fraction(self, accumulator, target_precision, n_min):
+        # Fraction of the PMTs (pixels or rings, if symmetric) with hits which have converged
+        lit = accumulator.counts > 0
+        return np.mean(accumulator.converged(target_precision, n_min)[lit]) if np.any(lit) else 0.
+
+    def _find_unconverged_pmts(self, accumulator, n_min, nevents):
+        # Keep and report the PMTs whose sigma is not known to self.target_precision
+        converged = self._statistics_to_pmts(accumulator.converged(self.target_precision, n_min))
+        amount_of_hits = self._statistics_to_pmts(accumulator.counts)    # All of the hits, calibrated PMT or not
+        self.unconverged_pmts = np.where(np.logical_not(converged))[0]
+        if len(self.unconverged_pmts) > 0:
+            logger.warning('%d PMTs (%d of them never hit) did not converge to a relative sigma error of %g in %d events (hit counts from %d to %d): %s' %
+                           (len(self.unconverged_pmts), np.count_nonzero(amount_of_hits[self.unconverged_pmts] == 0), self.target_precision, nevents,
+                            np.min(amount_of_hits[self.unconverged_pmts]), np.max(amount_of_hits[self.unconverged_pmts]),
+                            str(self.unconverged_pmts)))
+
+    def _write_checkpoint(self, checkpoint_file, simname, accumulator, events_done):
+        # Write to a temporary file and rename, so an interruption never leaves a partial checkpoint
+        temp_file = checkpoint_file + '.tmp'
+        with h5py.File(temp_file, 'w') as h5file:
+            h5file.attrs['config_UUID'] = str(self.config.uuid)
+            h5file.attrs['simulation_file'] = os.path.basename(simname)
+            h5file.attrs['simulation_mtime'] = os.path.getmtime(simname)   # Detect a re-simulated file with the same name
+            h5file.attrs['events_consumed'] = events_done
+            h5file.attrs['lens_symmetric'] = self.lens_symmetric    # The sums are per PMT, per template pixel or per ring
+            h5file.attrs['ring_symmetric'] = self.ring_symmetric
+            h5file.attrs.update(self._binning_attrs())
+            accumulator.write_to_hdf5(h5file)
+        os.rename(temp_file, checkpoint_file)
+        logger.info('Calibration checkpoint written: %s (%d events)' % (checkpoint_file, events_done))
+
+    def _read_checkpoint(self, checkpoint_file, simname):
+        # Returns the accumulator and number of events consumed from a matching checkpoint, or (None, 0)
+        if not os.path.exists(checkpoint_file):
+            return None, 0
+        with h5py.File(checkpoint_file, 'r') as h5file:
+            if h5file.attrs['config_UUID'] != str(self.config.uuid) or h5file.attrs['simulation_file'] != os.path.basename(simname) \
+                    or h5file.attrs['simulation_mtime'] != os.path.getmtime(simname):
+                logger.warning('Calibration checkpoint %s does not match this configuration and simulation file.  Ignoring it.' % checkpoint_file)
+                return None, 0
+            # Sums of another calibration mode can have the same size (e.g. lens symmetric with a single lens system)
+            if 'lens_symmetric' not in h5file.attrs or bool(h5file.attrs['lens_symmetric']) != self.lens_symmetric \
+                    or bool(h5file.attrs['ring_symmetric']) != self.ring_symmetric:
+                logger.warning('Calibration checkpoint %s is for another calibration mode (lens or ring symmetric).  Ignoring it.' % checkpoint_file)
+                return None, 0
+            if not self._same_binning(h5file.attrs):
+                logger.warning('Calibration checkpoint %s was binned with %s (%s PMT ids), not %s (%s).  Ignoring it.' %
+                               (checkpoint_file, h5file.attrs.get('binning'), h5file.attrs.get('pmt_dtype'), self.binning, np.dtype(self.pmt_dtype).name))
+                return None, 0
+            accumulator = CalibrationAccumulator.read_from_hdf5(h5file)
+            events_done = int(h5file.attrs['events_consumed'])
+        if accumulator.npmt_bins != self._statistics_bins():
+            logger.warning('Calibration checkpoint %s has %d PMT bins, expected %d.  Ignoring it.' % (checkpoint_file, accumulator.npmt_bins, self._statistics_bins()))
+            return None, 0
+        logger.info('Resuming calibration from checkpoint: %s (%d events)' % (checkpoint_file, events_done))
+        return accumulator, events_done
+
+    def update_calibration(self, simnames, n_min=10, workers=1):
+        # Fold the photons of one or more additional simulation files into a calibration read
+        # (with its per-PMT sums) from a file written by write_to_hdf5().  Only the new files are
+        # processed; the means and sigmas are recomputed from the combined sums.
+        if self.calibration_statistics is None:
+            raise ValueError('Calibration has no stored per-PMT statistics to update.  Recalibrate with calibrate()')
+        start_time = time.time()
+        if self.calibration_events is None:
+            logger.warning('Calibration has no event count: per event statistics only count the events added now')
+        nevents = self.calibration_events or 0
+        for simname in simnames:
+            if simname.endswith('.h5'):
+                with h5py.File(simname, 'r') as h5file:
+                    sim_uuid = h5file.attrs.get('config_UUID')
+                if sim_uuid is None:
+                    logger.warning('Simulation file has no configuration UUID; cannot check it: %s' % simname)
+                elif sim_uuid != str(self.config.uuid):
+                    raise ValueError('UUID from simulation file %s does not match configuration: %s %s' % (simname, sim_uuid, self.config.uuid))
+            else:
+                logger.warning('Cannot check the configuration UUID of ROOT simulation file: %s' % simname)
+            # Recognize the simulation files already used by their contents, whatever their name or location
+            simulation_hash = simulation_reader.content_hash(simname)
+            if simulation_hash in self.simulation_hashes:
+                logger.warning('Simulation file is already part of the calibration.  Skipping: %s' % simname)
+                continue
+            if not self.simulation_hashes and os.path.basename(simname) in self.simulation_files:
+                # Older calibration files only have the file names
+                logger.warning('Simulation file name is already part of the calibration (no content hashes to compare).  Skipping: %s' % simname)
+                continue
+
+            logger.info('Updating calibration with: %s' % simname)
+            accumulator, events = self._accumulate_file(simname, workers)
+            self.calibration_statistics.merge(accumulator)
+            self.simulation_files.append(os.path.basename(simname))
+            self.simulation_hashes.append(simulation_hash)
+            nevents += events
+            logger.info('Events accumulated: %d.  Time: %s' % (nevents, str(time.time() - start_time)))
+
+        total_means, total_variances, total_u_minus_v, amount_of_hits = self._pmt_calibration(self.calibration_statistics, n_min, self.calibration_ddof)
+        self.calibration_events = nevents
+        self._store_calibration(total_means, total_variances, np.abs(total_u_minus_v), amount_of_hits, nevents, n_min)
+        if self.target_precision is not None:
+            self._find_unconverged_pmts(self.calibration_statistics, n_min, nevents)
+        self.is_calibrated = True
+
+    def _accumulate_file(self, simname, workers=1):
+        # Returns the sums for all of the events of 'simname', and the number of events
+        global _shard_calibration
+
+        nevents = simulation_reader.count_events(simname)
+        if workers < 2:
+            return self._accumulate_events(simname, 0, nevents), nevents
+        accumulator = CalibrationAccumulator(self._statistics_bins())
+        _shard_calibration = (self, simname)
+        pool = multiprocessing.Pool(workers)
+        try:
+            for partial in pool.map(_accumulate_shard, split_event_range(0, nevents, workers)):
+                accumulator.merge(partial)
+        finally:
+            pool.close()
+            pool.join()
+            _shard_calibration = None
+        return accumulator, nevents
+
+    def _accumulate_events(self, simname, first, last):
+        # Fold the events in range(first, last) of simname into a new CalibrationAccumulator
+        start_time = time.time()
+        _, event_source = self._simulation_events(simname, first, last)
+        accumulator = CalibrationAccumulator(self._statistics_bins())
+        loops = 0
+        n_det = 0
+        for photons_beg, photons_end in event_source:
+            loops += 1
+            detected = (photons_end.flags & (0x1 <<2)).astype(bool)
+            pmt_b, end_dir = self._photon_directions(photons_beg.pos, photons_end.pos, detected)
+            if self.lens_symmetric:
+                pmt_b, end_dir = self._to_calibration_frame(pmt_b, end_dir)
+            accumulator.add(pmt_b, end_dir)
+            n_det += len(pmt_b)
+            if loops % 100 == 0:
+                logger.info("Event " + str(first+loops) + " of [" + str(first) + ", " + str(last) + ")")
+                logger.info('Photons detected so far: ' + str(n_det))
+                logger.info("Time: " + str(time.time() - start_time))
+                logger.handlers[0].flush()
+        return accumulator
+
+    def _statistics_bins(self):
+        # Number of pixels the calibration sums are kept for
+        if self.ring_symmetric:
+            return len(self.ring)
+        return self.n_pmts_per_surf if self.lens_symmetric else self.npmt_bins
+
+    def _to_calibration_frame(self, pmt_bins, directions):
+        # Pixel within its lens system, and direction rotated into that lens system's template frame.
+        # For a ring symmetric calibration: the ring, and the direction also rotated by minus the pixel azimuth.
+        lenses = pmt_bins // self.n_pmts_per_surf
+        pixels = pmt_bins % self.n_pmts_per_surf
+        local_directions = np.einsum('nji,nj->ni', self.lens_rotation_matrices[lenses], directions)
+        if not self.ring_symmetric:
+            return pixels, local_directions
+        azimuths = self.pixel_azimuths[pixels]
+        cos_az, sin_az = np.cos(azimuths), np.sin(azimuths)
+        ring_directions = np.column_stack((cos_az*local_directions[:,0] + sin_az*local_directions[:,1],
+                                           cos_az*local_directions[:,1] - sin_az*local_directions[:,0],
+                                           local_directions[:,2]))
+        return self.pixel_rings[pixels], ring_directions
+
+    def _statistics_to_pmts(self, values):
+        # Expand per ring or per template pixel values to every PMT
+        if self.ring_symmetric:
+            values = values[self.pixel_rings]
+        if self.lens_symmetric:
+            values = np.tile(values, len(self.lens_rotation_matrices))
+        return values
+
+    def _directions_to_pmts(self, directions):
+        # Rotate (n, 3) directions per ring or per template pixel out to every PMT
+        if self.ring_symmetric:
+            azimuths = self.pixel_azimuths
+            ring_directions = directions[self.pixel_rings]
+            cos_az, sin_az = np.cos(azimuths), np.sin(azimuths)
+            directions = np.column_stack((cos_az*ring_directions[:,0] - sin_az*ring_directions[:,1],
+                                          sin_az*ring_directions[:,0] + cos_az*ring_directions[:,1],
+                                          ring_directions[:,2]))
+        if self.lens_symmetric:
+            directions = np.einsum('lij,pj->lpi', self.lens_rotation_matrices, directions).reshape(-1, 3)
+        return directions
+
+    def _pmt_calibration(self, accumulator, n_min, ddof):
+        # Mean angle, variance, u-v variance difference and photon count for every PMT from the
+        # sums in 'accumulator'.  For a lens (ring) symmetric calibration, the statistics of each pixel
+        # (ring) of the template lens system are rotated back out to all of the pixels.
+        means, variances, u_minus_v = accumulator.finalize(n_min, ddof)
+        counts = accumulator.counts.copy()
+        counts[(counts < 2) | (counts < n_min)] = 0     # Count only the calibrated PMTs, as the in-memory calibration does
+        if self.ring_symmetric:
+            self.ring_means = -means.astype(self.float_dtype)     # Same sign convention as self.means
+            self.ring_sigmas = np.sqrt(variances.astype(self.float_dtype))
+        return self._directions_to_pmts(means), self._statistics_to_pmts(variances), \
+               self._statistics_to_pmts(u_minus_v), self._statistics_to_pmts(counts)
+
+    def _store_calibration(self, total_means, total_variances, total_u_minus_v, amount_of_hits, nevents, n_min):
         # temporary, for debugging:
         n_hits = np.sum(amount_of_hits, axis=0)
         print "Total hits for calibrated PMTs: " + str(n_hits)
@@ -401,8 +742,8 @@ class DetectorResponseGaussAngle(DetectorResponse):
         print "Mean U-V variance (abs): " + str(np.mean(total_u_minus_v))
 
         # Store final calibrated values
-        self.means = -total_means.astype(np.float32).T
-        self.sigmas = np.sqrt(total_variances.astype(np.float32))
+        self.means = -total_means.astype(self.float_dtype).T
+        self.sigmas = np.sqrt(total_variances.astype(self.float_dtype))
 
     def calibrate_old(self, simname, nevents=-1):
         # Use with a simulation file 'simname' to calibrate the detector
@@ -514,9 +855,63 @@ class DetectorResponseGaussAngle(DetectorResponse):
                 print "Nan read in for bin index " + str(bin_ind)
         logger.info('Last bin_index: %d' % bin_ind)
 
+    def write_to_hdf5(self, filename):
+        # Config dict is just included for human readability (currently)
+        detector_data = {'config': self.config, 'config_dict': vars(self.config)}
+        detector_data.update(self._binning_attrs())   # Reconstruction must bin hits the same way (see read_from_hdf5())
+        # Per PMT values are always written, so that any reader finds them
+        detector_data['means'] = self.means
+        detector_data['sigmas'] = self.sigmas
+        if self.ring_symmetric:
+            detector_data['ring_means'] = self.ring_means     # Ring calibration model the per PMT values come from
+            detector_data['ring_sigmas'] = self.ring_sigmas
+        if self.calibration_statistics is not None:
+            # Sufficient statistics, so that update_calibration() can extend the calibration later
+            detector_data['pmt_counts'] = self.calibration_statistics.counts
+            detector_data['direction_sums'] = self.calibration_statistics.direction_sums
+            detector_data['second_moments'] = self.calibration_statistics.second_moments
+            detector_data['variance_ddof'] = self.calibration_ddof
+            detector_data['lens_symmetric'] = self.lens_symmetric
+            detector_data['ring_symmetric'] = self.ring_symmetric
+            detector_data['simulation_files'] = list(self.simulation_files)
+            detector_data['simulation_hashes'] = list(self.simulation_hashes)
+            if self.calibration_events is not None:
+                detector_data['calibration_events'] = self.calibration_events
+        if self.target_precision is not None:
+            # Convergence report of a calibration to a target precision
+            detector_data['target_precision'] = self.target_precision
+            detector_data['unconverged_pmts'] = self.unconverged_pmts
+        dd.io.save(filename, detector_data)
+
     def read_from_hdf5(self, filename):
         calibration = dd.io.load(filename)
-        self.means = calibration['means']
-        self.sigmas = calibration['sigmas']
+        if 'ring_means' in calibration:
+            self.lens_symmetric = self.ring_symmetric = True
+            self.ring_means = np.asarray(calibration['ring_means']).astype(self.float_dtype, copy=False)
+            self.ring_sigmas = np.asarray(calibration['ring_sigmas']).astype(self.float_dtype, copy=False)
+        if 'means' in calibration:
+            self.means = np.asarray(calibration['means']).astype(self.float_dtype, copy=False)
+            self.sigmas = np.asarray(calibration['sigmas']).astype(self.float_dtype, copy=False)
+        else:   # Ring symmetric files written with the ring model only
+            self.means = self._directions_to_pmts(self.ring_means).T.astype(self.float_dtype, copy=False)
+            self.sigmas = self._statistics_to_pmts(self.ring_sigmas)
+        # Pixel ids depend on the binning method, so use the one the calibration was made with.  Older files were all
+        # made with the KD-tree.  The PMT id dtype is only recorded: the pixel ids are the same in compact mode.
+        calibration_binning = calibration.get('binning', 'kdtree')
+        if calibration_binning not in BINNING_METHODS:
+            raise ValueError('Unknown binning method in calibration file %s: %s' % (filename, calibration_binning))
+        if calibration_binning != self.binning:
+            logger.warning('Calibration file %s was made with %s binning: using it instead of %s' % (filename, calibration_binning, self.binning))
+            self.binning = calibration_binning
         self.is_calibrated = True
         self.config_in_cal_file = calibration['config']  # Long variable name to avoid overwriting config set in DetectorResponse.init()
+        self.target_precision = calibration.get('target_precision')
+        self.unconverged_pmts = calibration.get('unconverged_pmts')
+        if 'pmt_counts' in calibration:        # Older calibration files only have the means and sigmas
+            self.calibration_statistics = CalibrationAccumulator.read_from_hdf5(calibration)
+            self.calibration_ddof = int(calibration['variance_ddof'])
+            self.lens_symmetric = bool(calibration['lens_symmetric'])
+            self.ring_symmetric = bool(calibration.get('ring_symmetric', False))
+            self.simulation_files = list(calibration['simulation_files'])
+            self.simulation_hashes = list(calibration.get('simulation_hashes', []))
+            self.calibration_events = calibration.get('calibration_events')
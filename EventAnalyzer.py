@@ -6,17 +6,95 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import mpl_toolkits.axisartist as AA
 from mpl_toolkits.axes_grid1 import host_subplot
+from numba import jit, prange
 from chroma.transform import normalize
 from chroma.sample import uniform_sphere
 
 import time as time
-from DetectorResponse import DetectorResponse
+from DetectorResponse import DetectorResponse, cells_in_sphere
 from DetectorResponsePDF import DetectorResponsePDF
 from DetectorResponseGaussAngle import DetectorResponseGaussAngle
 from Tracks import Tracks, Vertex
 
 from logger_lfd import logger
 
+SEED_PROB_TOL = 1e-20   # Normalized seed probabilities below this are dropped, as in EventAnalyzer.gauss_prob()
+SEED_TOP_K = 8          # Cells refined at each level of the seed search (see EventAnalyzer.find_seed())
+SEED_REFINE_LEVELS = 3  # Default number of halvings of the detector bins in the seed search
+VERTEX_FIT_METHODS = ('irls', 'fmin')
+IRLS_MAX_ITER = 50      # Reweighted least squares steps per annealing temperature (see EventAnalyzer.irls_vertex())
+IRLS_XTOL = 1e-4        # Stop when the vertex moves less than this (as optimize.fmin's default xtol)
+IRLS_OBJ_RTOL = 1e-4    # Relative increase of the objective accepted from an IRLS update (it minimizes the objective
+                        # at fixed weights, so near convergence it can end up marginally above the starting value)
+SEED_OCTANTS = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], dtype=float)
+
+@jit(nopython=True, nogil=True, error_model='numpy')
+def _seed_gauss(hit_pos, means, sigmas, positions, t, p):
+    # Unnormalized Gaussian of track t at position p, in the tangent of the angle between the track and the
+    # direction from its hit position to p: EventAnalyzer.gauss_prob(np.tan(EventAnalyzer.get_angles(...)), sig)
+    x = positions[p, 0] - hit_pos[0, t]
+    y = positions[p, 1] - hit_pos[1, t]
+    z = positions[p, 2] - hit_pos[2, t]
+    cos_r = (x*means[0, t] + y*means[1, t] + z*means[2, t])/np.sqrt(x*x + y*y + z*z)
+    cos_r = min(max(cos_r, -1.0), 1.0)
+    tan_sq = (1.0 - cos_r*cos_r)/(cos_r*cos_r)
+    return np.exp(-tan_sq/(2.0*sigmas[t]*sigmas[t]))
+
+@jit(nopython=True, nogil=True, parallel=True, error_model='numpy')
+def _seed_norms(hit_pos, means, sigmas, positions, norms):
+    # Fills norms (n_tracks,) with the sum of each track's seed Gaussian over the positions (threads over tracks)
+    n_positions = positions.shape[0]
+    for t in prange(hit_pos.shape[1]):
+        total = 0.0
+        for p in range(n_positions):
+            total += _seed_gauss(hit_pos, means, sigmas, positions, t, p)
+        norms[t] = total
+
+@jit(nopython=True, nogil=True, parallel=True, error_model='numpy')
+def _seed_pdf(hit_pos, means, sigmas, multiplicity, positions, norms, pdf):
+    # Fills pdf (n_positions,) with the sum over tracks of each track's seed Gaussian, divided by its normalization
+    # and counted multiplicity times (threads over positions).  Gaussians are recomputed rather than kept from
+    # _seed_norms(), so no (tracks, positions) array is built.  Tracks whose normalization is zero or NaN add nothing.
+    n_tracks = hit_pos.shape[1]
+    for p in prange(positions.shape[0]):
+        total = 0.0
+        for t in range(n_tracks):
+            if norms[t] > 0.0:
+                prob = _seed_gauss(hit_pos, means, sigmas, positions, t, p)/norms[t]
+                if prob >= SEED_PROB_TOL:
+                    total += multiplicity[t]*prob
+        pdf[p] = total
+
+@jit(nopython=True, nogil=True, error_model='numpy')
+def _track_fit_objective(hit_pos, means, sigmas, multiplicity, lens_rad, vtx_pos, chiC, Tm, sig_out, chi_out, wt_out):
+    # EventAnalyzer.get_track_fit_params() in one pass over the tracks: returns the objective, and fills sig_out,
+    # chi_out and wt_out (n,) with the scaled sigmas, chi and weights unless they are empty.  Same arithmetic as
+    # Tracks.closest_pts_sigmas(), Vertex.dist() and EventAnalyzer.get_weights(), without the temporaries.
+    keep_sig = sig_out.shape[0] > 0
+    keep_chi = chi_out.shape[0] > 0
+    keep_wt = wt_out.shape[0] > 0
+    chiC_sq = chiC*chiC
+    weighted_chi_sq = 0.0
+    weight_sum = 0.0
+    for i in range(hit_pos.shape[1]):
+        r_proj = ((vtx_pos[0] - hit_pos[0, i])*means[0, i] + (vtx_pos[1] - hit_pos[1, i])*means[1, i] +
+                  (vtx_pos[2] - hit_pos[2, i])*means[2, i])
+        dx = hit_pos[0, i] + means[0, i]*r_proj - vtx_pos[0]
+        dy = hit_pos[1, i] + means[1, i]*r_proj - vtx_pos[1]
+        dz = hit_pos[2, i] + means[2, i]*r_proj - vtx_pos[2]
+        sig = sigmas[i]*r_proj + lens_rad
+        chi = np.sqrt(dx*dx + dy*dy + dz*dz)/sig
+        wt = 1.0/(1.0 + np.exp((chi*chi - chiC_sq)/(2*Tm)))
+        weighted_chi_sq += multiplicity[i]*wt*chi*chi
+        weight_sum += multiplicity[i]*wt
+        if keep_sig:
+            sig_out[i] = sig
+        if keep_chi:
+            chi_out[i] = chi
+        if keep_wt:
+            wt_out[i] = wt
+    return weighted_chi_sq/weight_sum
+
 class EventAnalyzer(object):
     '''An EventAnalyzer has methods of reconstructing an event and gauging
     the performance of this reconstruction. There are multiple ways to do
@@ -227,12 +305,13 @@ class EventAnalyzer(object):
         # the true directions the photons came from
         
         # Create a list of tracks (from hits and detector response, if calibrated, else w/ perfect resolution)
-        tracks = self.generate_tracks(event, heat_map=False,sig_cone=sig_cone, n_ph=n_ph, lens_dia=None,debug=False)
+        # Photons hitting the same PMT are kept as one weighted track: the fit costs scale with lit PMTs rather than photons
+        tracks = self.generate_tracks(event, heat_map=False,sig_cone=sig_cone, n_ph=n_ph, lens_dia=None,debug=False,unique=True)
         
         # Find/fit vertices using adaptive vertex fitter method
         return self.AVF(tracks, min_tracks, chiC, temps, tol, debug) # list of Vertex objects
 
-    def AVF(self, tracks, min_tracks=4, chiC=3., temps=[256, 0.25], tol=1.0, debug=False):
+    def AVF(self, tracks, min_tracks=4, chiC=3., temps=[256, 0.25], tol=1.0, debug=False, vertex_fit='irls'):
         '''Adaptive vertex fitter algorithm to find vertex locations/uncertainties and which tracks 
         to associate with each vertex.
         The algorithm, in brief:
@@ -247,8 +326,14 @@ class EventAnalyzer(object):
             Tracks with weight >0.5 are associated to the resulting vertex, and remaining tracks
             are fed back to the algorithm to find the next vertex.
             If min_tracks<1, use as a fraction of the total event's tracks.
+        Tracks are weighted by their multiplicity (the number of photons each stands for) in the seed PDF, the
+        objective and the track counts, so deduplicated tracks give the same vertices as one track per photon.
+        vertex_fit picks the vertex update at each temperature: 'irls' (closed form reweighted least squares, with
+        Nelder-Mead as the fallback) or 'fmin' (Nelder-Mead only).
         '''
         WEIGHT_CUT = 0.50
+        if vertex_fit not in VERTEX_FIT_METHODS:
+            raise ValueError('Unknown vertex fit method: %s (expected one of %s)' % (vertex_fit, str(VERTEX_FIT_METHODS)))
 
         # Get an array of voxel positions within the detector, for repeated use
         bin_pos_array = np.array(self.det_res.bin_to_position_array())  # Returns 10x10x10 = 1000 coordinate positions
@@ -266,36 +351,38 @@ class EventAnalyzer(object):
         # Find vertices iteratively until insufficient tracks remain
         min_global = 10 # No matter what, vertices must have this many tracks
         if min_tracks < 1.0: # Use fraction of total event's tracks
-            min_tracks = int(min_tracks*float(len(tracks)))
+            min_tracks = int(min_tracks*float(tracks.n_photons()))
         min_tracks = max(min_global, min_tracks)
-        while len(tracks) >= min_tracks:
+        while tracks.n_photons() >= min_tracks:
             # Find initial vertex location - get gaussian probabilities at each of the detector locations
-            # Repurpose get_angles and gauss_prob to operate on all tracks at once? 
             final_pdf = np.zeros((self.det_res.detectorxbins, self.det_res.detectorybins, self.det_res.detectorzbins))
             f_squared = np.zeros((self.det_res.detectorxbins, self.det_res.detectorybins, self.det_res.detectorzbins))
  
             t0 = time.time()
-            for ii, (hit_pos, mean, sig) in enumerate(tracks):
-                # print hit_pos
-                # print mean
-                # print sig
-                # print 'bin_pos shape: ' + str(np.shape(bin_pos_array))
-                #if ii > 10:
+            if not doNLL:
+                # Coarse-to-fine search for the maximum of the summed Gaussian seed PDF of all tracks
+                v_pos_max = self.find_seed(tracks)
+                if debug:   # Seed PDF on the full grid, for plotting
+                    final_pdf = self.seed_pdf(tracks, bin_pos_array).reshape(np.shape(final_pdf))
+            else:
+                for ii, (hit_pos, mean, sig) in enumerate(tracks):
+                    # print hit_pos
+                    # print mean
+                    # print sig
+                    # print 'bin_pos shape: ' + str(np.shape(bin_pos_array))
+                    #if ii > 10:
 					#break
                 
-                angles = np.reshape(self.get_angles(hit_pos, bin_pos_array, mean),np.shape(final_pdf))
-                #print 'angles shape: ' + str(np.shape(angles))
-                dists_scaled = np.tan(angles) # scaled so that projection of vector onto mean angle is 1
-                #print 'dists scaled shape: ' + str(np.shape(dists_scaled)) # sig is (n,)
-                if np.isnan(sig):
-                    logger.info('Track sig is nan - skipping.')
-                if doNLL:
+                    angles = np.reshape(self.get_angles(hit_pos, bin_pos_array, mean),np.shape(final_pdf))
+                    #print 'angles shape: ' + str(np.shape(angles))
+                    dists_scaled = np.tan(angles) # scaled so that projection of vector onto mean angle is 1
+                    #print 'dists scaled shape: ' + str(np.shape(dists_scaled)) # sig is (n,)
+                    if np.isnan(sig):
+                        logger.info('Track sig is nan - skipping.')
                     gp = self.gauss_nll(dists_scaled, sig)
-                else:
-                    gp = self.gauss_prob(dists_scaled, sig)
-                final_pdf += gp
-                #final_pdf *= gp
-                #f_squared += gp**2
+                    final_pdf += tracks.multiplicity[ii]*gp
+                    #final_pdf *= gp
+                    #f_squared += gp**2
             # Replace any value divided by 0 with 0, replace negative values with 0
             #zero_mask = 1.0*(final_pdf == 0.)
             #final_pdf_mask = np.ma.masked_array(final_pdf, zero_mask, fill_value=0.)
@@ -311,9 +398,10 @@ class EventAnalyzer(object):
 
             t1 = time.time()
             #print "Initial vtx location time: " + str(t1-t0)
-            max_bin = np.argmax(final_pdf)
-            #max_bin = np.argmax(V_final)
-            v_pos_max = bin_pos_array[max_bin]
+            if doNLL:
+                max_bin = np.argmax(final_pdf)
+                #max_bin = np.argmax(V_final)
+                v_pos_max = bin_pos_array[max_bin]
             #v_pos_max = np.array([0.,0.,0.]) # Could consider using this for n_ph>100...
 
             # # Get center of mass of neighboring bins to max_bin to use as initial vtx pos
@@ -453,32 +541,43 @@ class EventAnalyzer(object):
                     #         print "Objective function failed to improve." 
                     #         print "Old value: " + str(obj0) + ", New value: " + str(obj1)
                     
-                    # Alternate method: find minimum numerically using scipy
-                    def obj_func(vtx_pos):
-                        vtx.pos = vtx_pos
-                        _, _, _, _, _, obj = self.get_track_fit_params(tracks, vtx, chiC, Tm)
-                        return obj
-
-                    # Minimizes obj_func; can set tolerance xtol and ftol but defaults of 1e-4 are good
-                    # disp=True will show convergence info
-                    # Check for improvement in objective?
-                    v_opt = optimize.fmin(obj_func, v_pos, disp=False)
-                    vtx.pos = v_opt
-                    _, _, _, _, _, obj1 = self.get_track_fit_params(tracks, vtx, chiC, Tm)
-                    # Retry w/ slightly different initial guess if outside detector or objective is worse
-                    n_tries = 1
-                    max_tries = 10
-                    while np.linalg.norm(v_opt) > self.det_res.inscribed_radius and obj1 > obj0 and n_tries < max_tries: 
-                        n_tries += 1
-                        logger.warning('Vertex placed outside of detector, or objective failed to improve - trying again, try '+str(n_tries))
-                        ddir_opt = uniform_sphere()
-                        # Shift by a distance of up to 10% of the inscribed radius, in a random direction
-                        drad_opt = 0.1*self.det_res.inscribed_radius*np.random.uniform(0.0, 1.0, 1)**(1.0/3)
-                        dv_opt = drad_opt*ddir_opt.T
-                        v_new = v_pos+dv_opt.T
-                        v_opt = optimize.fmin(obj_func, v_new, disp=False)
+                    # Closed form reweighted least squares update (see irls_vertex()); Nelder-Mead is the fallback if
+                    # a step is singular, or the vertex ends up outside the detector or with a (clearly) worse objective
+                    v_opt = None
+                    if vertex_fit == 'irls':
+                        v_opt = self.irls_vertex(tracks, v_pos, chiC, Tm)
+                    if v_opt is not None:
+                        vtx.pos = v_opt
+                        obj1 = self.track_objective(tracks, vtx, chiC, Tm)
+                        if obj1 > obj0*(1+IRLS_OBJ_RTOL) or np.linalg.norm(v_opt) > self.det_res.inscribed_radius:
+                            logger.info('IRLS vertex update failed to improve - falling back to Nelder-Mead')
+                            v_opt = None
+                    if v_opt is None:
+                        # Fallback: find minimum numerically using scipy
+                        def obj_func(vtx_pos):
+                            vtx.pos = vtx_pos
+                            return self.track_objective(tracks, vtx, chiC, Tm)
+
+                        # Minimizes obj_func; can set tolerance xtol and ftol but defaults of 1e-4 are good
+                        # disp=True will show convergence info
+                        # Check for improvement in objective?
+                        v_opt = optimize.fmin(obj_func, v_pos, disp=False)
                         vtx.pos = v_opt
-                        _, _, _, _, _, obj1 = self.get_track_fit_params(tracks, vtx, chiC, Tm)
+                        obj1 = self.track_objective(tracks, vtx, chiC, Tm)
+                        # Retry w/ slightly different initial guess if outside detector or objective is worse
+                        n_tries = 1
+                        max_tries = 10
+                        while np.linalg.norm(v_opt) > self.det_res.inscribed_radius and obj1 > obj0 and n_tries < max_tries: 
+                            n_tries += 1
+                            logger.warning('Vertex placed outside of detector, or objective failed to improve - trying again, try '+str(n_tries))
+                            ddir_opt = uniform_sphere()
+                            # Shift by a distance of up to 10% of the inscribed radius, in a random direction
+                            drad_opt = 0.1*self.det_res.inscribed_radius*np.random.uniform(0.0, 1.0, 1)**(1.0/3)
+                            dv_opt = drad_opt*ddir_opt.T
+                            v_new = v_pos+dv_opt.T
+                            v_opt = optimize.fmin(obj_func, v_new, disp=False)
+                            vtx.pos = v_opt
+                            obj1 = self.track_objective(tracks, vtx, chiC, Tm)
 
                     v_pos = v_opt    
                     
@@ -504,14 +603,14 @@ class EventAnalyzer(object):
                     print "dv record: " + str(dv_rec)
                     #print "Weight record: " + str(wt_rec)
                     print "Objective function record: " + str(obj_rec)
-                    logger.info('Tracks associated with this vertex: %d' % len(tracks))
+                    logger.info('Tracks associated with this vertex: %d' % tracks.n_photons())
                     # Make plot of vtx pos vs iteration, weights and obj function vs iteration
                     self.plot_tracks(tracks,path=np.array(v_pos_rec).T)
                     self.plot_weights(np.array(wt_rec),obj=np.array(obj_rec))
                     #self.plot_weights(np.random.random_sample(np.shape(np.array(wt_rec))),obj=np.array(obj_rec))
                 # TODO: calculate error
                 # TODO: check that final associated tracks are at least min_tracks, else break
-                vtx_ph = np.sum(1.0*(wt0 >= 0.5))
+                vtx_ph = np.sum(tracks.multiplicity*(wt0 >= 0.5))
                 #print "Associated tracks: " + str(vtx_ph)
                 vtx.n_ph = vtx_ph
                 vtx_list.append(vtx)
@@ -536,18 +635,18 @@ class EventAnalyzer(object):
             # Cull tracks to only those tracks which were not already associated
             #tracks.cull(np.nonzero(wt_list[opt_ind]>1.1)) # Use this to stop after 1st vtx is found
             tracks.cull(np.nonzero(wt_list[opt_ind]<WEIGHT_CUT))
-            logger.info('>>>>>>>> Remaining tracks: %d' % len(tracks))
+            logger.info('>>>>>>>> Remaining tracks: %d' % tracks.n_photons())
 
             # Check that vertex has a (normalized) objective function less than qual*chiC
             qual = 0.95
             #qual = 2 
-            _, _, _, _, _, obj_fin = self.get_track_fit_params(trx_assoc, vtx, chiC, 1.0)
+            obj_fin = self.track_objective(trx_assoc, vtx, chiC, 1.0)
             if debug:
                 print 'obj_fin (uses only associated tracks): %f / %f' % (obj_fin, qual*chiC)
-                print "Associated tracks: " + str(len(trx_assoc))
-            if obj_fin < qual*chiC and len(trx_assoc) >= min_tracks:
+                print "Associated tracks: " + str(trx_assoc.n_photons())
+            if obj_fin < qual*chiC and trx_assoc.n_photons() >= min_tracks:
                 vtx.err = obj_fin # use objective function to judge quality of vertex
-                vtx.n_ph = len(trx_assoc)
+                vtx.n_ph = trx_assoc.n_photons()
                 vtcs.append(vtx)
             else: # If the vertex quality is poor or has too few tracks, stop looking for more vertices
                 logger.info('Vertex quality too poor / too few tracks: %f, Targets: %f %d. Dropping and quitting.' % (obj_fin, qual*chiC, min_tracks))
@@ -603,8 +702,8 @@ class EventAnalyzer(object):
             # Keep only tracks closest to this vtx
             tracks_assoc.cull(np.nonzero(vtx_closest==ind)) 
             vtx.tracks = tracks_assoc # Record the tracks for this vertex
-            vtx.n_ph = len(tracks_assoc)
-            _, _, _, _, _, obj_assoc = self.get_track_fit_params(tracks_assoc, vtx, chiC, 1.0)
+            vtx.n_ph = tracks_assoc.n_photons()
+            obj_assoc = self.track_objective(tracks_assoc, vtx, chiC, 1.0)
             vtx.err = obj_assoc # use objective function to judge quality of vertex
         
 
@@ -631,8 +730,10 @@ class EventAnalyzer(object):
             mask.extend(fltr)
         return sorted(mask)
 
-    def generate_tracks(self, ev, qe=None, heat_map = False, sig_cone=0.01, n_ph=0, lens_dia=None, debug=False, detec=False):
+    def generate_tracks(self, ev, qe=None, heat_map = False, sig_cone=0.01, n_ph=0, lens_dia=None, debug=False, detec=False, unique=False):
         #Makes tracks for event ev; allow for multiple track representations?
+        #unique: with a calibrated detector, photons hitting the same PMT give identical tracks; return one track per
+        #hit PMT (in PMT order), with the number of photons as its multiplicity, rather than one track per photon
         detected = (ev.photons_end.flags & (0x1 <<2)).astype(bool)
         logger.info('Detected: ' + str(detected))
         logger.info(str(ev.photons_end.flags));
@@ -660,7 +761,7 @@ class EventAnalyzer(object):
             length = n_ph
 
         end_direction_array = normalize(ending_photons-beginning_photons).T
-        event_pmt_bin_array, lenses, rings, pixels = np.array(self.det_res.find_pmt_bin_array_new(ending_photons)) # Get PMT hit indices
+        event_pmt_bin_array, lenses, rings, pixels = self.det_res.find_pmt_bin_array_new(ending_photons) # Get PMT hit indices (each in its own dtype)
 
         if qe == None:
             good_photons = detected
@@ -677,9 +778,7 @@ class EventAnalyzer(object):
             good_photons[mask] = 1
 
         # print('PMT bins: ' + str(event_pmt_bin_array))
-        event_pmt_pos_array = np.array(self.det_res.pmt_bin_to_position(event_pmt_bin_array)).T
-        event_lens_bin_array = np.array(event_pmt_bin_array/self.det_res.n_pmts_per_surf)
-        event_lens_pos_array = np.array([self.det_res.lens_centers[x] for x in event_lens_bin_array]).T
+        event_pmt_pos_array = self.det_res.pmt_bin_to_position(event_pmt_bin_array).T
         
         # If detector is not calibrated or not of the GaussAngle subclass, use actual photon angles
         # plus Gaussian noise (two different models, depending on if lens_dia is given)
@@ -738,15 +837,22 @@ class EventAnalyzer(object):
             return tracks
 
         else: # Detector is calibrated, use response to generate tracks
+            if unique:
+                track_pmt_bins, first, multiplicity = np.unique(event_pmt_bin_array, return_index=True, return_counts=True)
+            else:
+                track_pmt_bins, first, multiplicity = event_pmt_bin_array, slice(None), None
             try:
-                tracks = Tracks(event_lens_pos_array,
-                                self.det_res.means[:,event_pmt_bin_array],
-                                self.det_res.sigmas[event_pmt_bin_array],
+                track_lens_pos_array = self.det_res.lens_centers[self.det_res.pmt_bin_lenses[track_pmt_bins]].T
+                tracks = Tracks(track_lens_pos_array,
+                                self.det_res.means[:,track_pmt_bins],
+                                self.det_res.sigmas[track_pmt_bins],
                                 lens_rad = self.det_res.lens_rad,
-                                lenses=lenses,
-                                rings=rings,
-                                pixels_in_ring=pixels,
-                                qe=qe)
+                                lenses=lenses[first],
+                                rings=rings[first],
+                                pixels_in_ring=pixels[first],
+                                qe=qe,
+                                compact=self.det_res.compact,
+                                multiplicity=multiplicity)
                 #tracks = Tracks(event_pmt_pos_array, self.det_res.means[:,event_pmt_bin_array], self.det_res.sigmas[event_pmt_bin_array], lens_rad = 0.0000001)
                 msk = tracks.sigmas > 0.001
                 tracks.cull(np.where(np.logical_not(msk))) # Remove tracks with zero uncertainty (not calibrated)
@@ -762,8 +868,9 @@ class EventAnalyzer(object):
                 #tracks.cull(np.where(tracks.sigmas<0.2)) # Remove tracks with too large uncertainty
                 #tracks.sigmas[:] = 0.054 # Temporary! Checking if setting all sigmas equal to each other helps or hurts
             if heat_map:
-                if detec: return tracks, event_pmt_bin_array[msk],good_photons.astype(bool)
-                return tracks, event_pmt_bin_array[msk]
+                calibrated_hits = event_pmt_bin_array[self.det_res.sigmas[event_pmt_bin_array] > 0.001]
+                if detec: return tracks, calibrated_hits,good_photons.astype(bool)
+                return tracks, calibrated_hits
             return tracks
 
     @staticmethod
@@ -771,6 +878,49 @@ class EventAnalyzer(object):
         # Returns an array of weights, according to the AVF sigmoid weighting function
         return 1.0/(1.0+np.exp((chi**2-chiC**2)/(2*Tm)))
  
+    @staticmethod
+    def irls_vertex(tracks, v_pos, chiC, Tm, max_iter=IRLS_MAX_ITER, xtol=IRLS_XTOL):
+        # Iteratively reweighted least squares fit of the vertex position, starting from v_pos, at temperature Tm.
+        # For fixed track weights c = multiplicity*wt/sig**2, the weighted sum of squared distances from the vertex
+        # to the track lines, sum(c*|P(v-hit_pos)|**2) with P the projection transverse to the track, is minimized
+        # in closed form by solving sum(c*P) v = sum(c*P hit_pos), a 3x3 system.  The weights and scaled sigmas
+        # are then recomputed at the new position, until the vertex moves less than xtol or max_iter steps.
+        # Returns the vertex position, or None if a step is singular or not finite.
+        vtx = Vertex(np.asarray(v_pos, dtype=np.float64), -1., 0)
+        means = np.asarray(tracks.means, dtype=np.float64)
+        hit_pos = np.asarray(tracks.hit_pos, dtype=np.float64)
+        means_sq = np.einsum('ij,ij->j', means, means)
+        hit_proj = np.einsum('ij,ij->j', means, hit_pos)/means_sq
+        sig = np.empty(len(tracks))
+        wt = np.empty(len(tracks))
+        for ii in range(max_iter):
+            EventAnalyzer.track_objective(tracks, vtx, chiC, Tm, sig=sig, wt=wt)
+            c = tracks.multiplicity*wt/sig**2
+            A = np.sum(c)*np.identity(3) - np.dot(means*(c/means_sq), means.T)
+            B = np.dot(hit_pos, c) - np.dot(means, c*hit_proj)
+            try:
+                v_new = np.linalg.solve(A, B)
+            except np.linalg.LinAlgError:
+                return None
+            if not np.all(np.isfinite(v_new)):
+                return None
+            step = np.linalg.norm(v_new - vtx.pos)
+            vtx.pos = v_new
+            if step < xtol:
+                break
+        return vtx.pos
+
+    @staticmethod
+    def track_objective(tracks, vtx, chiC, Tm, sig=None, chi=None, wt=None):
+        # Objective function of get_track_fit_params() from a compiled kernel that walks the tracks once, for the
+        # inner loops of the vertex fit.  sig, chi and wt are optional (n,) float64 arrays to fill with the scaled
+        # sigmas, chi and weights.  Equal to the get_track_fit_params() values up to summation order.
+        no_output = np.empty(0)
+        return _track_fit_objective(tracks.hit_pos, tracks.means, tracks.sigmas, tracks.multiplicity, float(tracks.lens_rad),
+                                    np.asarray(vtx.pos, dtype=np.float64), float(chiC), float(Tm),
+                                    no_output if sig is None else sig, no_output if chi is None else chi,
+                                    no_output if wt is None else wt)
+
     @staticmethod
     def get_track_fit_params(tracks, vtx, chiC, Tm):
         # Calculates distance, weight, and more for tracks being associated to vtx
@@ -785,7 +935,7 @@ class EventAnalyzer(object):
         # d - distances from r to vtx
         # chi - d in units of sigma
         # wt - weight for each track
-        # obj - objective function (weighted sum of squared distances)
+        # obj - objective function (weighted sum of squared distances, each track counted multiplicity times)
         
         # Calculate closest points along the tracks to vtx and scale sigmas by the length along the tracks
         r, sig = tracks.closest_pts_sigmas(vtx)
@@ -799,7 +949,8 @@ class EventAnalyzer(object):
         # chi = d
         # wt = np.ones(wt.shape) 
 	
-        obj = np.sum(wt*chi**2)/np.sum(wt) # Get current value of objective function
+        mult_wt = tracks.multiplicity*wt
+        obj = np.sum(mult_wt*chi**2)/np.sum(mult_wt) # Get current value of objective function
         return r, sig, d, chi, wt, obj
  
     def plot_tracks(self, _tracks, pts=None, highlight_pt=None, path=None, show=True, skip_interval=200):
@@ -1000,6 +1151,56 @@ class EventAnalyzer(object):
         cos_r = np.clip(cos_r, -1.0, 1.0) # Restrict to valid cosine values (avoids rounding error)
         return np.arccos(cos_r) # Return angles between r_vec and L
         
+    @staticmethod
+    def _seed_track_arrays(tracks):
+        # float32 copies of the track arrays, as the seed kernels take them
+        return [np.ascontiguousarray(a, dtype=np.float32) for a in (tracks.hit_pos, tracks.means, tracks.sigmas)]
+
+    @staticmethod
+    def seed_norms(tracks, positions):
+        # Returns the normalization (n_tracks,) of each track's seed Gaussian over positions (n, 3) (see seed_pdf())
+        hit_pos, means, sigmas = EventAnalyzer._seed_track_arrays(tracks)
+        norms = np.empty(len(sigmas))
+        _seed_norms(hit_pos, means, sigmas, np.ascontiguousarray(positions, dtype=np.float32).reshape(-1, 3), norms)
+        return norms
+
+    @staticmethod
+    def seed_pdf(tracks, positions, norms=None):
+        # Returns the seed PDF of AVF at positions (n, 3): the sum over tracks of gauss_prob() of the tangents of the
+        # angles from each track to the positions, weighted by track multiplicity.  Computed by a compiled,
+        # multi-threaded kernel from float32 copies of the track arrays (arithmetic and sums in float64), with the
+        # result as float32 (n,).  Each track is normalized over positions, unless norms (from seed_norms()) are given.
+        hit_pos, means, sigmas = EventAnalyzer._seed_track_arrays(tracks)
+        positions = np.ascontiguousarray(positions, dtype=np.float32).reshape(-1, 3)
+        if norms is None:
+            norms = np.empty(len(sigmas))
+            _seed_norms(hit_pos, means, sigmas, positions, norms)
+        multiplicity = np.ascontiguousarray(tracks.multiplicity, dtype=np.float32)
+        pdf = np.empty(len(positions), dtype=np.float32)
+        _seed_pdf(hit_pos, means, sigmas, multiplicity, positions, norms, pdf)
+        return pdf
+
+    def find_seed(self, tracks, top_k=SEED_TOP_K, resolution=None):
+        # Coarse-to-fine search for the maximum of the seed PDF.  Starts from the detector bins that overlap the
+        # inscribed sphere, then splits the top_k cells of each level into octants (dropping those outside the
+        # sphere), until the cells are no larger than resolution (default: the bins halved SEED_REFINE_LEVELS times).
+        # Tracks are normalized over the coarse bins at every level, so all levels weight them the same.
+        # Returns the center of the best cell.
+        coarse_positions = self.det_res.fiducial_bin_positions()
+        cell_size = self.det_res.bin_size()
+        if resolution is None:
+            resolution = np.max(cell_size)/2**SEED_REFINE_LEVELS
+        norms = self.seed_norms(tracks, coarse_positions)
+        positions = coarse_positions
+        pdf = self.seed_pdf(tracks, positions, norms)
+        while np.max(cell_size) > resolution:
+            best = positions[np.argsort(pdf)[-top_k:]]
+            cell_size = cell_size/2.
+            positions = (best[:, np.newaxis, :] + SEED_OCTANTS*cell_size/2.).reshape(-1, 3)
+            positions = positions[cells_in_sphere(positions, cell_size/2., self.det_res.inscribed_radius)]
+            pdf = self.seed_pdf(tracks, positions, norms)
+        return positions[np.argmax(pdf)]
+
     @staticmethod
     def gauss_prob(vals, sig):
         #Returns an array of Gaussian probabilities with mean=0, sigma=sig
@@ -8,7 +8,20 @@ class Tracks(object):
     a hit position, a direction (in 3D), and an uncertainty on the transverse position,
     normalized to unit length (so the track profile is a cone).
     '''
-    def __init__(self, hit_pos, means, sigmas, lenses=None, rings=None, pixels_in_ring=None, lens_rad=0, qe=None):
+    def __init__(self, hit_pos, means, sigmas, lenses=None, rings=None, pixels_in_ring=None, lens_rad=0, qe=None, compact=False, multiplicity=None):
+        # compact: store float32 positions, directions and sigmas, int32 lenses and uint16 rings and pixels in ring.
+        # closest_pts_sigmas() works in float64 (the vertex position upcasts the track arrays).
+        # multiplicity: number of photons each track stands for (default one each).  Photons hitting the same PMT give
+        # identical tracks, so they can be kept as one track (see EventAnalyzer.generate_tracks(unique=True)).
+        if multiplicity is None:
+            multiplicity = np.ones(len(sigmas), dtype=int)
+        if compact:
+            hit_pos, means, sigmas = [np.asarray(a).astype(np.float32, copy=False) for a in (hit_pos, means, sigmas)]
+            if lenses is not None:
+                lenses = np.asarray(lenses).astype(np.int32, copy=False)
+                rings = np.asarray(rings).astype(np.uint16, copy=False)
+                pixels_in_ring = np.asarray(pixels_in_ring).astype(np.uint16, copy=False)
+            multiplicity = np.asarray(multiplicity).astype(np.int32, copy=False)
         self.hit_pos = hit_pos # (3, n) numpy array
         self.means = means # (3, n) numpy array
         self.sigmas = sigmas # (n,) numpy array
@@ -17,11 +30,22 @@ class Tracks(object):
         self.pixels_in_rings = pixels_in_ring
         self.lens_rad = lens_rad
         self.qe = qe
+        self.multiplicity = multiplicity # (n,) numpy array
         self.printed_warning = False
 
+    def __setstate__(self, state):
+        # Tracks pickled before multiplicities were kept stand for one photon each
+        self.__dict__.update(state)
+        if 'multiplicity' not in state:
+            self.multiplicity = np.ones(len(self.sigmas), dtype=int)
+
     def __len__(self):
         #Returns the number of tracks in self.
         return len(self.sigmas)
+
+    def n_photons(self):
+        #Returns the number of photons the tracks stand for (the sum of their multiplicities).
+        return int(np.sum(self.multiplicity))
         
     def __iter__(self):
         #Allows for iterating over tracks. 
@@ -36,6 +60,7 @@ class Tracks(object):
         self.hit_pos = self.hit_pos[:,ind_remain]
         self.means = self.means[:,ind_remain]
         self.sigmas = self.sigmas[ind_remain]
+        self.multiplicity = self.multiplicity[ind_remain]
         if self.lenses is not None:   # Use lenses as a proxy None check for the others
             self.lenses = self.lenses[ind_remain]
             self.rings = self.rings[ind_remain]
@@ -49,7 +74,7 @@ class Tracks(object):
             #print "right lens_rad used:	", self.lens_rad
         # Returns an array of positions along the tracks closest to Vertex v, along with
         # an array of the sigmas scaled by the distance along the track to that point
-        r_vec = (v.pos - self.hit_pos.T).T
+        r_vec = (np.asarray(v.pos, dtype=np.float64) - self.hit_pos.T).T
         r_proj = np.einsum('ij,ij->j',r_vec,self.means) # Get projections onto direction vectors
         #print "r_proj: " + str(r_proj)
         r_fin = self.hit_pos+self.means*r_proj
@@ -0,0 +1,147 @@
+#
+# analytic_geometry.py
+# Closed form versions of the geometry that DetectorResponse reads off the chroma meshes built in kabamland2: the
+# triangle centers of the curved detecting surfaces and the centers of the lens systems.  Only NumPy is needed,
+# and no meshes are built.  The conventions (rotations, extrusion order, triangle order and the diagonal splitting each
+# quad) follow chroma's make.rotate_extrude(), make.mesh_grid() and transform.make_rotation_matrix().
+# compare_with_meshes() checks them against the kabamland2 meshes: the triangle centers and lens centers of
+# cfSam1_l200_p107600_b4_e10 agree to rounding (about 1e-12 mm).  Re-run it after changing kabamland2, lenssystem or
+# this file:  python analytic_geometry.py <config name> ...
+#
+
+import numpy as np
+
+def normalize(x):
+    # Same as chroma.transform.normalize: unit vector(s) along the last axis
+    x = np.asarray(x, dtype=float)
+    return x/np.sqrt(np.sum(x**2, axis=-1))[..., np.newaxis]
+
+def make_rotation_matrix(phi, n):
+    # Same convention as chroma.transform.make_rotation_matrix
+    n = np.asarray(n, dtype=float)/np.linalg.norm(n)
+    return np.cos(phi)*np.identity(3) + (1-np.cos(phi))*np.outer(n,n) + \
+        np.sin(phi)*np.array([[0,n[2],-n[1]],[-n[2],0,n[0]],[n[1],-n[0],0]])
+
+def rot_axis(norm,r_norm):
+    # Angles and axes of the rotations taking norm to each of r_norm
+    if not np.array_equal(norm,r_norm):
+        norm = np.broadcast_to(norm,r_norm.shape)
+    norm = normalize(norm)
+    r_norm = normalize(r_norm)
+    axis = normalize(np.cross(norm,r_norm))
+    phi = np.arccos(np.einsum('ij,ij->i',norm,r_norm))
+    return phi, axis
+
+def get_lens_rotation_matrices(vtx):
+    # Rotation of each lens system from the template frame (lens axis along z); the same rotations place
+    # the lenses and curved surfaces above, so a template point p lands at np.dot(R, p) + displacement
+    phi, axs = rot_axis([0,0,1],vtx)
+    return np.asarray([make_rotation_matrix(ph,ax) for ph,ax in zip(-phi,axs)])
+
+def curved_surface_profile(detector_r=2.0, diameter=2.5, nsteps=8):
+    # Profile (radius, height) of the ring edges of curved_surface2(), a spherical cap of radius detector_r
+    if (detector_r < diameter/2.0):
+        raise Exception('The Radius of the curved surface must be larger than diameter/2.0')
+    shift1 = np.sqrt(detector_r**2 - (diameter/2.0)**2)
+    theta1 = np.arctan(shift1/(diameter/2.0))
+    angles1 = np.linspace(theta1, np.pi/2, nsteps)
+    x_value = abs(detector_r*np.cos(angles1))
+    y_value = detector_r-detector_r*np.sin(angles1)
+    return x_value, y_value
+
+def calc_steps(x_value,y_value,detector_r,base_pixel):
+    # Ring edges and number of pixels per ring: pixel area is kept close to that of the innermost ring's base_pixel pixels
+    x_coord = np.asarray([x_value,np.roll(x_value,-1)]).T[:-1]
+    y_coord = np.asarray([y_value,np.roll(y_value,-1)]).T[:-1]
+    lat_area = 2*np.pi*detector_r*(y_coord[:,0]-y_coord[:,1])
+    n_step = (lat_area/lat_area[-1]*base_pixel).astype(int)
+    return x_coord, y_coord, n_step
+
+def get_curved_surf_ring_edges(detector_r=1.0, rad=1.0, nsteps=10):
+    # Polar angles (about the center of curvature, from the lens axis) of the ring edges of curved_surface2(detector_r, 2*rad, nsteps):
+    # ring i lies between edges[i+1] and edges[i], ring 0 being the outermost
+    theta1 = np.arctan(np.sqrt(detector_r**2 - rad**2)/rad)
+    return np.pi/2 - np.linspace(theta1, np.pi/2, nsteps)
+
+def _extruded_points(x, y, angles):
+    # Profile point (x, y) extruded to the given azimuths and turned so that the extrusion axis is z, as
+    # mh.rotate(make.rotate_extrude(...), make_rotation_matrix(-np.pi/2, (1,0,0))) does: (n_angles, 3)
+    return np.array([x*np.cos(angles), x*np.sin(angles), np.full(len(angles), y)]).T
+
+def ring_triangle_centers(x, y, n_step):
+    # Triangle centers of make.rotate_extrude(x, y, n_step) for a two point profile, lens axis along z, assuming step j has
+    # triangles (p1_j, p0_j, p0_j+1) and, n_step triangles later, (p1_j, p0_j+1, p1_j+1) (the mesh_grid() layout; the order
+    # and quad diagonal set the centers the KD-tree binning uses)
+    angles = np.linspace(0, 2*np.pi, n_step, endpoint=False)
+    next_angles = np.roll(angles, -1)
+    p0, p0_next = _extruded_points(x[0], y[0], angles), _extruded_points(x[0], y[0], next_angles)
+    p1, p1_next = _extruded_points(x[1], y[1], angles), _extruded_points(x[1], y[1], next_angles)
+    return np.concatenate(((p1 + p0 + p0_next)/3., (p1 + p0_next + p1_next)/3.))
+
+def curved_surf_template_triangle_centers(detector_r=2.0, diameter=2.5, nsteps=8, base_pxl=4):
+    # Triangle centers of the curved surface of one lens system, lens axis along z (as in get_curved_surf_triangle_centers()
+    # before placement), and the number of pixels in each ring
+    x_value, y_value = curved_surface_profile(detector_r, diameter, nsteps)
+    x_coord, y_coord, n_step = calc_steps(x_value, y_value, detector_r, base_pxl)
+    centers = np.concatenate([ring_triangle_centers(x, y, n_stp) for x, y, n_stp in zip(x_coord, y_coord, n_step)])
+    return centers, n_step
+
+def get_curved_surf_triangle_centers(vtx, rad, detector_r = 1.0, focal_length=1.0, nsteps = 10, b_pxl=4):
+    # Closed form counterpart of kabamland2.get_curved_surf_triangle_centers() (see the note at the top of this file)
+    template_centers, ring = curved_surf_template_triangle_centers(detector_r, 2*rad, nsteps, b_pxl)
+    vtx = np.asarray(vtx, dtype=float)
+    displacements = -normalize(vtx)*(np.linalg.norm(vtx, axis=1)+focal_length)[:,np.newaxis]
+    rotation_matrices = get_lens_rotation_matrices(vtx)
+    centers = np.einsum('kij,nj->kni', rotation_matrices, template_centers) + displacements[:, np.newaxis, :]
+    return centers.reshape(-1, 3), len(template_centers), ring
+
+def lens_assembly_center(profiles):
+    # Mean of the triangle vertices of the lens meshes built from profiles (see lenssystem.get_lens_profiles()), lens
+    # axis along z.  Assuming each profile segment gives two triangles per azimuthal step (the same number of steps for
+    # every lens), with three corners at each end of the segment, the azimuths cancel: the mean is on the axis, at the
+    # mean of the segment midpoint heights.
+    heights = []
+    for x, y, axial_shift in profiles:
+        y = np.asarray(y, dtype=float)
+        heights.append(-(y[:-1] + y[1:])/2. + axial_shift)    # Profile height y is turned to -z
+    return np.array([0., 0., np.mean(np.concatenate(heights))])
+
+def get_lens_triangle_centers(vtx, rad, diameter_ratio, thickness_ratio, half_EPD, blockers=True, blocker_thickness_ratio=1.0/1000, light_confinement=False, focal_length=1.0, lens_system_name=None):
+    # Counterpart of kabamland2.get_lens_triangle_centers(), from the lens profiles rather than the lens meshes
+    import lenssystem
+    lens_center = lens_assembly_center(lenssystem.get_lens_profiles(lens_system_name, rad*diameter_ratio))
+    return np.dot(get_lens_rotation_matrices(vtx), lens_center) - np.asarray(vtx)
+
+def compare_with_meshes(config):
+    # Largest differences between the analytic and mesh (kabamland2, needs chroma) triangle centers and lens centers.
+    # Both should be at rounding level for the analytic geometry to stand in for the meshes.
+    import kabamland2
+    rad = config.half_EPD/config.EPD_ratio
+    args = (config.vtx, rad, config.detector_r, config.focal_length, config.ring_count, config.base_pixels)
+    analytic_centers, analytic_count, analytic_ring = get_curved_surf_triangle_centers(*args)
+    mesh_centers, mesh_count, mesh_ring = kabamland2.get_curved_surf_triangle_centers(*args)
+    if analytic_count != mesh_count or not np.array_equal(analytic_ring, mesh_ring):
+        raise ValueError('Analytic and mesh curved surfaces differ: %d and %d triangles' % (analytic_count, mesh_count))
+    lens_args = (config.vtx, rad, config.diameter_ratio, config.thickness_ratio, config.half_EPD)
+    analytic_lenses = get_lens_triangle_centers(*lens_args, lens_system_name=config.lens_system_name)
+    mesh_lenses = kabamland2.get_lens_triangle_centers(*lens_args, lens_system_name=config.lens_system_name)
+    return np.max(np.abs(analytic_centers - mesh_centers)), np.max(np.abs(analytic_lenses - mesh_lenses))
+
+# Check the analytic geometry against the meshes for the given configurations
+if __name__ == '__main__':
+    import argparse
+    import detectorconfig
+
+    parser = argparse.ArgumentParser('Compare the analytic geometry with the kabamland2 meshes')
+    parser.add_argument('config_names', nargs='+', help='Configuration names')
+    parser.add_argument('--tolerance', '-t', type=float, default=1e-6, help='Largest difference allowed (mm)')
+    args = parser.parse_args()
+
+    failed = False
+    for config_name in args.config_names:
+        triangle_difference, lens_difference = compare_with_meshes(detectorconfig.get_detector_config(config_name))
+        passed = max(triangle_difference, lens_difference) <= args.tolerance
+        failed = failed or not passed
+        print('%s: triangle centers %g, lens centers %g: %s' % (config_name, triangle_difference, lens_difference, 'OK' if passed else 'FAILED'))
+    if failed:
+        exit(1)
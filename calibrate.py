@@ -7,7 +7,7 @@ import psutil
 
 import paths
 import detectorconfig
-from DetectorResponse import DetectorResponse
+from DetectorResponse import DetectorResponse, BINNING_METHODS, GEOMETRY_METHODS
 from DetectorResponsePDF import DetectorResponsePDF
 from DetectorResponseGaussAngle import DetectorResponseGaussAngle
 import lensmaterials as lm
@@ -21,6 +21,7 @@ from chroma.detector import G4DetectorParameters
 # Which inits the whole Geant4 module.  This line in __init__ fires Geant4 up: gRunManagerKernel = G4RunManagerKernel.GetRunManagerKernel()
 
 USE_ROOT = False
+DEFAULT_CHECKPOINT_INTERVAL = 500    # Events between calibration checkpoints
 
 # TODO: Move this method and uniform_photons to utilities?
 def _full_detector_simulation(config, kabamland, amount, simname, datadir=""):
@@ -78,30 +79,56 @@ def _full_detector_simulation(config, kabamland, amount, simname, datadir=""):
 
 # From detectoranalysis - TODO: remove it from there
 # saves a detector response list of pdfs-1 for each pixel-given a simulation file of photons emitted isotropically throughout the detector.
-def _calibrate(config, photons_file, detresname, detxbins=10, detybins=10, detzbins=10, method="PDF", nevents=-1, datadir="", fast_calibration=True):
+def _calibrate(config, photons_file, detresname, detxbins=10, detybins=10, detzbins=10, method="PDF", nevents=-1, datadir="", fast_calibration=True, streaming=False, workers=1, checkpoint_interval=0,
+               target_precision=None, converged_fraction=0.95, lens_symmetric=False, ring_symmetric=False, n_min=10,
+               binning='kdtree', geometry='mesh', geometry_cache=True, query_threads=1):
     logger.info('Calibrating with: ' + datadir + photons_file)
     if method == "PDF":
         dr = DetectorResponsePDF(config, detxbins, detybins, detzbins)       # Do we need to continue to carry this?
     elif method == "GaussAngle":
-        dr = DetectorResponseGaussAngle(config, detxbins, detybins, detzbins)
+        dr = DetectorResponseGaussAngle(config, detxbins, detybins, detzbins, binning=binning, geometry=geometry, geometry_cache=geometry_cache,
+                                        query_threads=query_threads)
     else:
         logger.warning('Warning: using generic DetectorResponse base class.')
-        dr = DetectorResponse(config)
-    dr.calibrate(datadir + photons_file, datadir, nevents, fast_calibration=fast_calibration)
+        dr = DetectorResponse(config, binning=binning, geometry_cache=geometry_cache, geometry=geometry, query_threads=query_threads)
+    dr.calibrate(datadir + photons_file, datadir, nevents, fast_calibration=fast_calibration, streaming=streaming, n_min=n_min, workers=workers, checkpoint_interval=checkpoint_interval,
+                 target_precision=target_precision, converged_fraction=converged_fraction,
+                 lens_symmetric=lens_symmetric, ring_symmetric=ring_symmetric)
     logger.info("=== Detector analysis calibration complete.  Writing calibration file")
 
     if USE_ROOT:
         # In this case write both hdf5 and ROOT files
         dr.write_to_ROOT(datadir + detresname + '.root')
 
-    # Config dict is just included for human readability (currently)
-    detector_data = {'config': dr.config, 'config_dict': vars(dr.config), 'means': dr.means, 'sigmas': dr.sigmas}
-    dd.io.save(datadir + detresname +'.h5', detector_data)
+    if method == "GaussAngle":
+        dr.write_to_hdf5(datadir + detresname + '.h5')     # Also stores the per-PMT sums, for update_calibration()
+    else:
+        # Config dict is just included for human readability (currently)
+        detector_data = {'config': dr.config, 'config_dict': vars(dr.config), 'means': dr.means, 'sigmas': dr.sigmas}
+        dd.io.save(datadir + detresname +'.h5', detector_data)
+
+def update_calibration(config, simulation_files, workers=1, n_min=10, binning='kdtree', geometry='mesh', geometry_cache=True, query_threads=1):
+    # Extends the existing calibration of 'config' with more simulation files, without re-reading
+    # the photons already in it.  Requires a calibration file written with its per-PMT sums.
+    calibration_file = paths.get_calibration_file_name(config.config_name)
+    dr = DetectorResponseGaussAngle(config, infile=calibration_file, binning=binning, geometry=geometry, geometry_cache=geometry_cache,
+                                    query_threads=query_threads)
+    if not dr.is_calibrated:
+        logger.critical('No calibration to update: %s' % calibration_file)
+        return
+    dr.update_calibration(simulation_files, n_min=n_min, workers=workers)
+    logger.info("=== Calibration update complete.  Writing calibration file")
+    if USE_ROOT:
+        dr.write_to_ROOT(paths.detector_calibration_path + paths.get_calibration_file_name_base_without_path(config.config_name) + '.root')
+    dr.write_to_hdf5(calibration_file)
+    logger.warning('==== Calibration updated: %s with %s ====' % (config.config_name, str(simulation_files)))
 
 
-def simulate_and_calibrate(config, build_only=False, force=False, fast_calibration=True):
+def simulate_and_calibrate(config, build_only=False, force=False, recalibrate=False, fast_calibration=True, streaming=False, workers=1, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+                           target_precision=None, converged_fraction=0.95, lens_symmetric=False, ring_symmetric=False, n_min=10,
+                           binning='kdtree', geometry='mesh', geometry_cache=True, query_threads=1):
     config_name = config.config_name
-    if (not force) and os.path.isfile(paths.get_calibration_file_name(config_name)):
+    if (not force) and (not recalibrate) and os.path.isfile(paths.get_calibration_file_name(config_name)):
         logger.info('Found calibration file: %s' % paths.get_calibration_file_name(config_name))
     else:
         logger.info('Failed to find calibration file: ' + paths.get_calibration_file_name(config_name))
@@ -134,21 +161,69 @@ def simulate_and_calibrate(config, build_only=False, force=False, fast_calibrati
                     simulation_file,
                     paths.get_calibration_file_name_base_without_path(config_name),
                     method="GaussAngle",
-                    nevents=10000,
+                    nevents=10000,      # Upper limit if calibrating to a target_precision
                     datadir=paths.detector_calibration_path,
-                    fast_calibration=fast_calibration)
+                    fast_calibration=fast_calibration,
+                    streaming=streaming,
+                    workers=workers,
+                    checkpoint_interval=checkpoint_interval,
+                    target_precision=target_precision,
+                    converged_fraction=converged_fraction,
+                    lens_symmetric=lens_symmetric,
+                    ring_symmetric=ring_symmetric,
+                    n_min=n_min,
+                    binning=binning,
+                    geometry=geometry,
+                    geometry_cache=geometry_cache,
+                    query_threads=query_threads)
             #os.remove(photons_file)  # Would need to remove both
-            logger.warning('==== Calibration complete: %s %s ====' % (config_name, 'fast' if fast_calibration else 'slow'))
+            calibration_mode = 'ring symmetric' if ring_symmetric else 'lens symmetric' if lens_symmetric else \
+                'streaming' if streaming or workers > 1 or target_precision is not None else 'fast' if fast_calibration else 'slow'
+            if checkpoint_interval > 0:
+                calibration_mode += ', checkpoints every %d events' % checkpoint_interval
+            logger.warning('==== Calibration complete: %s %s ====' % (config_name, calibration_mode))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('config_name', help='Configuration name')
     parser.add_argument('--build_only', '-b', action='store_true', help='Build the detector only.  Do not calibrate.')
     parser.add_argument('--force_build', '-f', action='store_true', help='Force rebuilding and calibrating the detector.')
+    parser.add_argument('--recalibrate', '-r', action='store_true', help='Calibrate again with the existing simulation file, replacing the calibration file.')
     parser.add_argument('--slow_calibration', '-s', action='store_true', help='Use slow calibration.')
+    parser.add_argument('--streaming', action='store_true', help='Use streaming calibration (per-PMT running sums, memory independent of photon count).')
+    parser.add_argument('--workers', '-w', type=int, default=1, help='Number of processes to calibrate with (implies streaming calibration if > 1).')
+    parser.add_argument('--checkpoint_interval', '-c', type=int, default=DEFAULT_CHECKPOINT_INTERVAL,
+                        help='Events between calibration checkpoints (collected hits, or running sums when streaming); re-running resumes from the last one.  0 disables checkpoints.')
+    parser.add_argument('--n_min', type=int, default=10,
+                        help='Fewest hits for a PMT to be calibrated.  With --recalibrate, reuses the hits file of a previous '
+                             'in-memory (non streaming) calibration of the same simulation file.')
+    parser.add_argument('--precision', '-p', type=float, default=None,
+                        help='Stop calibrating once enough PMTs have this relative standard error on sigma (implies streaming calibration).')
+    parser.add_argument('--converged_fraction', type=float, default=0.95, help='Fraction of PMTs which must reach --precision.')
+    parser.add_argument('--lens_symmetric', action='store_true',
+                        help='Calibrate the pixels of all lens systems together, in the lens system frame (implies streaming calibration).')
+    parser.add_argument('--ring_symmetric', action='store_true',
+                        help='Calibrate one mean angle and sigma per ring of the curved surface (implies --lens_symmetric).')
+    parser.add_argument('--binning', choices=BINNING_METHODS, default='kdtree',
+                        help='How to find the pixel of each hit: KD-tree over all triangles, lens system then a one surface KD-tree, or analytic '
+                             '(the last two are checked against the KD-tree on the first event).')
+    parser.add_argument('--geometry', choices=GEOMETRY_METHODS, default='mesh',
+                        help='Triangle and lens centers from the chroma meshes, or in closed form with NumPy only (see analytic_geometry).')
+    parser.add_argument('--no_geometry_cache', action='store_true', help='Do not read or write the geometry cache file.')
+    parser.add_argument('--query_threads', type=int, default=1, help='Threads for the KD-tree queries of the hit binning.')
+    parser.add_argument('--update', '-u', nargs='+', metavar='SIMULATION_FILE',
+                        help='Add the photons of these simulation files to the existing calibration.')
     _args = parser.parse_args()
     config_name = _args.config_name
 
     config = detectorconfig.get_detector_config(config_name)
-    simulate_and_calibrate(config, build_only=_args.build_only, force=_args.force_build, fast_calibration=not _args.slow_calibration)
+    if _args.update:
+        update_calibration(config, _args.update, workers=_args.workers, n_min=_args.n_min, binning=_args.binning,
+                           geometry=_args.geometry, geometry_cache=not _args.no_geometry_cache, query_threads=_args.query_threads)
+    else:
+        simulate_and_calibrate(config, build_only=_args.build_only, force=_args.force_build, recalibrate=_args.recalibrate, fast_calibration=not _args.slow_calibration, streaming=_args.streaming, workers=_args.workers, checkpoint_interval=_args.checkpoint_interval,
+                               target_precision=_args.precision, converged_fraction=_args.converged_fraction,
+                               lens_symmetric=_args.lens_symmetric, ring_symmetric=_args.ring_symmetric, n_min=_args.n_min,
+                               binning=_args.binning, geometry=_args.geometry, geometry_cache=not _args.no_geometry_cache,
+                               query_threads=_args.query_threads)
 
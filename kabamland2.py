@@ -15,6 +15,7 @@ from chroma.event import Photons
 import detectorconfig, lenssystem
 import lensmaterials as lm
 import meshhelper as mh
+from analytic_geometry import rot_axis, calc_steps, curved_surface_profile, get_curved_surf_ring_edges, get_lens_rotation_matrices
 
 inputn = 16.0
 
@@ -24,17 +25,9 @@ def lens(diameter, thickness, nsteps=inputn):
     b = np.linspace(diameter/2, 0, nsteps/2)
     return make.rotate_extrude(np.concatenate((a, b)), np.concatenate((2*thickness/diameter**2*(a)**2-0.5*thickness, -2.0*thickness/diameter**2*(b)**2+0.5*thickness)), nsteps=inputn)
 
-def rot_axis(norm,r_norm):
-        if not np.array_equal(norm,r_norm):
-                norm = np.broadcast_to(norm,r_norm.shape)
-        norm = normalize(norm)
-        r_norm = normalize(r_norm)
-        axis = normalize(np.cross(norm,r_norm))
-        phi = np.arccos(np.einsum('ij,ij->i',norm,r_norm))
-        return phi, axis
-
 def cylindrical_shell(inner_radius, outer_radius, thickness, nsteps=inputn):
     #make sure that nsteps is the same as that of rotate extrude in lens
+    #a single rotate_extrude mesh, so rotated/shifted copies can skip duplicate vertex removal
     #inner_radius must be less than outer_radius
     return make.rotate_extrude([inner_radius, outer_radius, outer_radius, inner_radius], [-thickness/2.0, -thickness/2.0, thickness/2.0, thickness/2.0], nsteps)
 
@@ -131,11 +124,7 @@ def get_lens_triangle_centers(vtx, rad, diameter_ratio, thickness_ratio, half_EP
 			lens_mesh += lns
 	X, Y, Z = get_assembly_xyz(lens_mesh)
 	lens_centers = np.asarray([np.mean(X), np.mean(Y), np.mean(Z)])
-	lns_center_arr = []
-        phi, axs = rot_axis([0,0,1],vtx)
-        for vx,ph,ax in zip(vtx,-phi,axs):
-		lns_center_arr.append(np.dot(make_rotation_matrix(ph,ax),lens_centers) - vx)
-	return np.asarray(lns_center_arr)
+	return mh.transform_points([lens_centers], get_lens_rotation_matrices(vtx), -np.asarray(vtx))[:,0]
 	
 
   
@@ -163,7 +152,7 @@ def build_lens_icosahedron(kabamland, vtx, rad, diameter_ratio, thickness_ratio,
             face += Solid(lns, lensmat, kabamland.detector_material)
 
     if light_confinement:
-        shield = mh.rotate(cylindrical_shell(rad*(1 - 0.001), rad, focal_length,32), make_rotation_matrix(np.pi/2.0, (1,0,0)))
+        shield = mh.rotate(cylindrical_shell(rad*(1 - 0.001), rad, focal_length,32), make_rotation_matrix(np.pi/2.0, (1,0,0)), remove_duplicate_vertices=False)
         baffle = Solid(shield, lensmat, kabamland.detector_material, black_surface, 0xff0000)
 
     if blockers:
@@ -171,7 +160,7 @@ def build_lens_icosahedron(kabamland, vtx, rad, diameter_ratio, thickness_ratio,
         if half_EPD < rad:
             c1 = lenssystem.get_lens_sys(lens_system_name).c1*lenssystem.get_scale_factor(lens_system_name,scale_rad)
             offset = [0,0,c1-np.sqrt(c1*c1-rad*rad)]
-            anulus_blocker = mh.shift(mh.rotate(cylindrical_shell(half_EPD, rad, blocker_thickness, 32), make_rotation_matrix(np.pi/2.0, (1,0,0))),offset)
+            anulus_blocker = mh.shift(mh.rotate(cylindrical_shell(half_EPD, rad, blocker_thickness, 32), make_rotation_matrix(np.pi/2.0, (1,0,0)), remove_duplicate_vertices=False),offset, remove_duplicate_vertices=False)
             face += Solid(anulus_blocker, lensmat, kabamland.detector_material, black_surface, 0xff0000)
     phi, axs = rot_axis([0,0,1],vtx)
     for vx,ph,ax in zip(vtx,-phi,axs):
@@ -180,26 +169,9 @@ def build_lens_icosahedron(kabamland, vtx, rad, diameter_ratio, thickness_ratio,
             kabamland.add_solid(baffle, rotation=make_rotation_matrix(ph,ax), displacement = -normalize(vx)*(np.linalg.norm(vx)+focal_length/2.0))
 
 
-def calc_steps(x_value,y_value,detector_r,base_pixel):
-	x_coord = np.asarray([x_value,np.roll(x_value,-1)]).T[:-1]
-	y_coord = np.asarray([y_value,np.roll(y_value,-1)]).T[:-1]
-	lat_area = 2*np.pi*detector_r*(y_coord[:,0]-y_coord[:,1])
-	n_step = (lat_area/lat_area[-1]*base_pixel).astype(int)
-	# print('Pixel areas per ring: %s' % str(lat_area / n_step))
-	# print('Coords: %s %s' % (x_coord, y_coord))
-	# print('Values: %s %s' % (x_value, y_value))
-	return x_coord, y_coord, n_step
-
 def curved_surface2(detector_r=2.0, diameter = 2.5, nsteps=8,base_pxl=4,ret_arr=False):
     '''Builds a curved surface based on the specified radius. Origin is center of surface.'''
-    if (detector_r < diameter/2.0):
-        raise Exception('The Radius of the curved surface must be larger than diameter/2.0')
-    shift1 = np.sqrt(detector_r**2 - (diameter/2.0)**2)
-    theta1 = np.arctan(shift1/(diameter/2.0))
-    angles1 = np.linspace(theta1, np.pi/2, nsteps)
-    # print('Parameters: %f %f %s' % (shift1, theta1, str(angles1)))
-    x_value = abs(detector_r*np.cos(angles1))
-    y_value = detector_r-detector_r*np.sin(angles1)
+    x_value, y_value = curved_surface_profile(detector_r, diameter, nsteps)
     surf = None 
     x_coord,y_coord,n_step = calc_steps(x_value,y_value,detector_r,base_pixel=base_pxl)
     for i,(x,y,n_stp) in enumerate(zip(x_coord,y_coord,n_step)):
@@ -213,14 +185,14 @@ def curved_surface2(detector_r=2.0, diameter = 2.5, nsteps=8,base_pxl=4,ret_arr=
 def get_curved_surf_triangle_centers(vtx, rad, detector_r = 1.0, focal_length=1.0, nsteps = 10, b_pxl=4):
     #Changed the rotation matrix to try and keep the curved surface towards the interior
     #Make sure diameter, etc. are set properly
-    curved_surf_triangle_centers = []
     mesh_surf, ring = curved_surface2(detector_r, diameter=2*rad, nsteps=nsteps, base_pxl=b_pxl,ret_arr=True)
     initial_curved_surf = mh.rotate(mesh_surf, make_rotation_matrix(-np.pi/2, (1,0,0)))     #-np.pi with curved_surface2
     triangles_per_surface = initial_curved_surf.triangles.shape[0]
-    phi, axs = rot_axis([0,0,1],vtx)
-    for vx,ph,ax in zip(vtx,-phi,axs):
-	curved_surf_triangle_centers.extend(mh.shift(mh.rotate(initial_curved_surf,make_rotation_matrix(ph,ax)),-normalize(vx)*(np.linalg.norm(vx)+focal_length)).get_triangle_centers())
-    return np.asarray(curved_surf_triangle_centers),triangles_per_surface,ring
+    # All of the lens systems at once, rather than a rotated and shifted copy of the mesh per lens system
+    vtx = np.asarray(vtx)
+    displacements = -normalize(vtx)*(np.linalg.norm(vtx, axis=1)+focal_length)[:,np.newaxis]
+    curved_surf_triangle_centers = mh.transformed_triangle_centers(initial_curved_surf, get_lens_rotation_matrices(vtx), displacements)
+    return curved_surf_triangle_centers,triangles_per_surface,ring
 
 def build_curvedsurface_icosahedron(kabamland, vtx, rad, diameter_ratio, focal_length=1.0, detector_r = 1.0, nsteps = 10, b_pxl=4):
     initial_curved_surf = mh.rotate(curved_surface2(detector_r, diameter=rad*2, nsteps=nsteps, base_pxl=b_pxl), make_rotation_matrix(-np.pi/2, (1,0,0)))
@@ -53,7 +53,21 @@ def get_system_measurements(lens_system_name, scale_rad):
 
 def get_lens_mesh_list(lens_system_name, scale_rad):
     # Returns a list of lens meshes for the given lens_system_name, scaled to match scale_rad
+    from chroma import make
     lenses = []
+    for x, y, axial_shift in get_lens_profiles(lens_system_name, scale_rad):
+        # rotate_extrude meshes have no duplicate vertices, so neither do their rotated/shifted copies
+        lens_mesh = mh.rotate(make.rotate_extrude(x, y, nsteps=64), make_rotation_matrix(np.pi/2, (1,0,0)), remove_duplicate_vertices=False)
+        if axial_shift:
+            lens_mesh = mh.shift(lens_mesh, (0., 0., axial_shift), remove_duplicate_vertices=False) # Shift relative to first lens along optical axis
+        lenses.append(lens_mesh)
+    return lenses
+
+def get_lens_profiles(lens_system_name, scale_rad):
+    # Returns a list of (x, y, axial_shift) lens profiles for the given lens_system_name, scaled to match scale_rad.
+    # Each lens is its profile extruded about the y axis and rotated so that y runs along -z, then shifted by
+    # axial_shift along z (see get_lens_mesh_list()).  Needs no meshes, for analytic_geometry.
+    profiles = []
     lens_sys = get_lens_sys(lens_system_name)
     scale_factor = get_scale_factor(lens_system_name, scale_rad)
     if lens_system_name == 'Jiani3':
@@ -75,8 +89,8 @@ def get_lens_mesh_list(lens_system_name, scale_rad):
         as_e2 = 9.869e-10/(scale_factor**3)
         as_f2 = -1.49e-15/(scale_factor**5)
         
-        as_mesh = mh.rotate(asphere_lens(as_rad, as_t, as_c1, as_k1, as_d1, as_e1, as_f1, as_c2, as_k2, as_d2, as_e2, as_f2, nsteps=64), make_rotation_matrix(np.pi/2, (1,0,0)))
-        lenses.append(as_mesh)
+        as_x, as_y = asphere_profile(as_rad, as_t, as_c1, as_k1, as_d1, as_e1, as_f1, as_c2, as_k2, as_d2, as_e2, as_f2, nsteps=64)
+        profiles.append((as_x, as_y, 0.))
     elif lens_system_name == 'Sam1':
         
         lens1rad = lens_sys.lens_rad*scale_factor
@@ -85,8 +99,8 @@ def get_lens_mesh_list(lens_system_name, scale_rad):
         lens1_c1 = (1./605.)/scale_factor
         lens1_c2 = (-1./535.)/scale_factor
         
-        l1_mesh = mh.rotate(asphere_lens(lens1rad, t1, lens1_c1, 0., 0., 0., 0., lens1_c2, 0., 0., 0., 0., nsteps=64), make_rotation_matrix(np.pi/2, (1,0,0)))
-        lenses.append(l1_mesh)
+        l1_x, l1_y = asphere_profile(lens1rad, t1, lens1_c1, 0., 0., 0., 0., lens1_c2, 0., 0., 0., 0., nsteps=64)
+        profiles.append((l1_x, l1_y, 0.))
         
         # Second lens
         lens2rad = lens_sys.sys_rad*scale_factor
@@ -95,11 +109,10 @@ def get_lens_mesh_list(lens_system_name, scale_rad):
         lens2_c1 = (1./760.)/scale_factor
         lens2_c2 = (-1./782.)/scale_factor
         
-        l2_mesh = mh.rotate(asphere_lens(lens2rad, t2, lens2_c1, 0., 0., 0., 0., lens2_c2, 0., 0., 0., 0., nsteps=64), make_rotation_matrix(np.pi/2, (1,0,0)))
+        l2_x, l2_y = asphere_profile(lens2rad, t2, lens2_c1, 0., 0., 0., 0., lens2_c2, 0., 0., 0., 0., nsteps=64)
         d2 = (t1-111.5*scale_factor)+(0.3+85.4)*scale_factor
-        l2_mesh = mh.shift(l2_mesh, (0., 0., -d2)) # Shift relative to first lens along optical axis
-        lenses.append(l2_mesh)
-    return lenses
+        profiles.append((l2_x, l2_y, -d2)) # Shift relative to first lens along optical axis
+    return profiles
         
 def get_lens_material(lens_system_name):
     # Returns the lens material for the given lens_system_name
@@ -111,7 +124,13 @@ def asphere_func(x, c, k, d, e, f):
     return c*(x**2)/(1+np.sqrt(1-(1+k)*(c**2)*(x**2))) + d*(x**2) + e*(x**4) + f*(x**6)
 
 def asphere_lens(rad, t, c1, k1, d1, e1, f1, c2, k2, d2, e2, f2, nsteps=128):
-    # Returns a mesh of an aspheric lens with two surfaces parametrized by c, k, d, e, f
+    # Returns a mesh of an aspheric lens with two surfaces parametrized by c, k, d, e, f (see asphere_profile())
+    from chroma import make
+    x, y = asphere_profile(rad, t, c1, k1, d1, e1, f1, c2, k2, d2, e2, f2, nsteps)
+    return make.rotate_extrude(x, y, nsteps=64)
+
+def asphere_profile(rad, t, c1, k1, d1, e1, f1, c2, k2, d2, e2, f2, nsteps=128):
+    # Returns the (x, y) profile of an aspheric lens with two surfaces parametrized by c, k, d, e, f
     # rad - radius of lens
     # t - thickness at widest point (if this is too small for the desired rad, will use min consistent thickness)
     # c - 1/(radius of curvature) in 1/mm
@@ -133,5 +152,4 @@ def asphere_lens(rad, t, c1, k1, d1, e1, f1, c2, k2, d2, e2, f2, nsteps=128):
     y1 = asphere_func(x1, c1, k1, d1, e1, f1)-ymax_1 # Shift so Y=0 plane is the first surface's edge
     y2 = asphere_func(x2, c2, k2, d2, e2, f2)+t-ymax_1 # Shift second surface to give appropriate thickness
 
-    from chroma import make
-    return make.rotate_extrude(np.concatenate((x1, x2)), np.concatenate((y1, y2)), nsteps=64)
+    return np.concatenate((x1, x2)), np.concatenate((y1, y2))
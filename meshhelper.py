@@ -1,20 +1,25 @@
 from chroma.geometry import Mesh
 import numpy as np
 
-def shift(mesh, shift):
+def shift(mesh, shift, remove_duplicate_vertices=True):
     #input shift as a vector
-    vertices = mesh.vertices
-    triangles = mesh.triangles
-    n = np.shape(vertices)[0]
-    newvertices = vertices + np.tile(shift, (n, 1))
-    return Mesh(newvertices, triangles, remove_duplicate_vertices=True)
+    #a shifted copy of a mesh without duplicate vertices has none either: pass remove_duplicate_vertices=False to skip the check
+    newvertices = mesh.vertices + np.asarray(shift)
+    return Mesh(newvertices, mesh.triangles, remove_duplicate_vertices=remove_duplicate_vertices)
 
-def rotate(mesh, rotation_matrix):
-    vertices = mesh.vertices
-    triangles = mesh.triangles
-    n = np.shape(vertices)[0]
-    newvertices = np.empty((n, 3))
-    for i in range(n):
-        newvertices[i] = np.dot(rotation_matrix, vertices[i])
-    return Mesh(newvertices, triangles, remove_duplicate_vertices=True)
+def rotate(mesh, rotation_matrix, remove_duplicate_vertices=True):
+    #same as shift(): rotating a mesh without duplicate vertices does not create any
+    newvertices = np.dot(mesh.vertices, np.asarray(rotation_matrix).T)
+    return Mesh(newvertices, mesh.triangles, remove_duplicate_vertices=remove_duplicate_vertices)
 
+def transform_points(points, rotation_matrices, displacements):
+    #places (n, 3) template points with each of (n_copies, 3, 3) rotation matrices and (n_copies, 3) displacements, in one product
+    #returns (n_copies, n, 3): the points of copy k are np.dot(rotation_matrices[k], p) + displacements[k]
+    points = np.asarray(points, dtype=float)
+    return np.einsum('kij,nj->kni', rotation_matrices, points) + np.asarray(displacements, dtype=float)[:, np.newaxis, :]
+
+def transformed_triangle_centers(mesh, rotation_matrices, displacements):
+    #triangle centers of every placed copy of the mesh, in the order of concatenating
+    #shift(rotate(mesh, rotation_matrices[k]), displacements[k]).get_triangle_centers() over k
+    #triangle centers are vertex means, so they are placed directly
+    return transform_points(mesh.get_triangle_centers(), rotation_matrices, displacements).reshape(-1, 3)
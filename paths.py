@@ -36,6 +36,9 @@ def get_calibration_file_name_without_path(config,FV=''):
 def get_calibration_file_name(config,FV=''):
     return detector_calibration_path+get_calibration_file_name_without_path(config,FV)
 
+def get_geometry_cache_file_name(config):              # DetectorResponse geometry (triangle centers, PMT tables, ...)
+    return detector_config_path+'geometry-'+config+'.h5'
+
 def get_data_file_path(config):
     return data_files_path+config+'/raw_data/'
 
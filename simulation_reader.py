@@ -0,0 +1,71 @@
+#
+# simulation_reader.py
+# Iterates over the events of a photon simulation file (hdf5 written by calibrate._full_detector_simulation, or ROOT)
+# without loading the whole file: hdf5 events are read a block of events at a time.
+#
+
+import hashlib
+import itertools
+import h5py
+
+from chroma.event import Photons
+
+DEFAULT_CHUNK_EVENTS = 10    # ~28 MB per block for 100,000 photon events
+
+def count_events(simname):
+    # Returns the number of events in the simulation file 'simname'
+    if simname.endswith('.h5'):
+        with h5py.File(simname, 'r') as h5file:
+            return len(h5file['photons_start'])
+    else:
+        from ShortIO.root_short import ShortRootReader
+        return len(ShortRootReader(simname))
+
+def content_hash(simname, block_bytes=1<<24):
+    # SHA-1 of the contents of the simulation file 'simname', read 16 MB at a time.  Identifies a
+    # simulation independently of its file name or modification time (e.g. for cached hits).
+    digest = hashlib.sha1()
+    with open(simname, 'rb') as sim_file:
+        block = sim_file.read(block_bytes)
+        while block:
+            digest.update(block)
+            block = sim_file.read(block_bytes)
+    return digest.hexdigest()
+
+def _aligned_block_size(dataset, chunk_events):
+    # Round the block size down to a whole number of dataset chunks along the event axis,
+    # so that no chunk is decompressed/read twice
+    events_per_chunk = dataset.chunks[0] if dataset.chunks else 1
+    return max(events_per_chunk, (chunk_events // events_per_chunk) * events_per_chunk)
+
+def iterate_h5_events(simname, first=0, last=None, chunk_events=DEFAULT_CHUNK_EVENTS):
+    # Yields (photons_beg, photons_end) Photons for the events in range(first, last) of the hdf5
+    # simulation file 'simname'.  Photon arrays are views into a block of chunk_events events, so
+    # peak memory is set by chunk_events rather than by the size of the file.
+    with h5py.File(simname, 'r') as h5file:
+        photons_start = h5file['photons_start']
+        photons_stop = h5file['photons_stop']
+        photon_flags = h5file['photon_flags']
+        if last is None or last > len(photons_start):
+            last = len(photons_start)
+        block_size = _aligned_block_size(photons_start, chunk_events)
+
+        block_start = first
+        while block_start < last:
+            block_stop = min(last, (block_start // block_size + 1) * block_size)   # Stay on the chunk grid
+            start_block = photons_start[block_start:block_stop]
+            stop_block = photons_stop[block_start:block_stop]
+            flags_block = photon_flags[block_start:block_stop]
+            for index in range(block_stop - block_start):
+                yield (Photons(start_block[index], [], [], []),
+                       Photons(stop_block[index], [], [], [], flags=flags_block[index]))
+            block_start = block_stop
+
+def iterate_events(simname, first=0, last=None, chunk_events=DEFAULT_CHUNK_EVENTS):
+    # Yields (photons_beg, photons_end) for the events in range(first, last) of an hdf5 or ROOT simulation file
+    if simname.endswith('.h5'):
+        return iterate_h5_events(simname, first, last, chunk_events)
+    else:
+        from ShortIO.root_short import ShortRootReader
+        reader = ShortRootReader(simname)
+        return ((ev.photons_beg, ev.photons_end) for ev in itertools.islice(reader, first, last))
@@ -458,9 +458,12 @@ def plot_tracks_from_endpoints(begin_pos, end_pos, pts=None, highlight_pt=None,
 if __name__=='__main__':
     import DetectorResponseGaussAngle
     import EventAnalyzer
+    from DetectorResponse import GEOMETRY_METHODS
 
     parser = argparse.ArgumentParser()
     parser.add_argument('h5_file', help='Event HDF5 file')
+    parser.add_argument('--geometry', choices=GEOMETRY_METHODS, default='mesh',
+                        help='Triangle and lens centers from the chroma meshes, or in closed form with NumPy only (see analytic_geometry).')
     args = parser.parse_args()
 
     event = DIEventFile.load_from_file(args.h5_file)
@@ -484,9 +487,9 @@ if __name__=='__main__':
         if calibrated_simulation:
             cal_file = paths.get_calibration_file_name(event.config_name)
             logger.info('Calibration file: ' + cal_file)
-            det_res = DetectorResponseGaussAngle.DetectorResponseGaussAngle(config, 10, 10, 10, cal_file)  # What are the 10s??
+            det_res = DetectorResponseGaussAngle.DetectorResponseGaussAngle(config, 10, 10, 10, cal_file, geometry=args.geometry)  # What are the 10s??
         else:
-            det_res = DetectorResponseGaussAngle.DetectorResponseGaussAngle(config, 10, 10, 10)   # What are the 10s??
+            det_res = DetectorResponseGaussAngle.DetectorResponseGaussAngle(config, 10, 10, 10, geometry=args.geometry)   # What are the 10s??
 
         logger.info('Tracks in file: %d' % len(event.tracks))
         analyzer = EventAnalyzer.EventAnalyzer(det_res)